@@ -1,95 +1,476 @@
 import random
+import time
 
-from model.models import Episode
 from datetime import datetime
-import re
 from support.TextRepo import TextRepo
 import logging
 from support.apiclient import SpreakerAPIClient
-from model.models import Show
+from model.models import Episode, EpisodeTopic, Show
 from model.custom_exceptions import ValueNotValid
-from typing import Dict, List
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
 from support.WordCounter import WordCounter
 from support.Cacher import Cacher
-from typing import Dict, List, Tuple, Set
-from model.models import Episode
-from unidecode import unidecode
+from support.configuration import SCORING_MODE, MAX_QUERY_WORDS, MAX_NGRAM_SIZE, QUERY_CACHE_SIZE
+from support.configuration import SEARCH_SHORTLIST, SHORTLIST_MIN_SCORE
+from support.configuration import SEARCH_EXECUTION_MODE, SEARCH_WORKERS, POLL_PAGE_SIZE
+from support.configuration import INGESTION_MODE, INGESTION_BATCH_SIZE
+from support.async_apiclient import AsyncSpreakerAPIClient
+from support.LRUCache import LRUCache
 import traceback
-import re
 from fuzzywuzzy import fuzz
-from model.models import EpisodeTopic
-from stop_words import get_stop_words
-from itertools import combinations
+from support.normalization import normalize_text, tokenize
+from itertools import combinations, takewhile
+from collections import defaultdict, deque
+from threading import Lock, Thread
+import heapq
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from rapidfuzz import process
+from rapidfuzz.distance import Indel
 
 logger = logging.getLogger('logic.logic')
 
 TopicSnippet = Tuple[str, EpisodeTopic, int, str, str, int]
+QueryCombinations = Tuple[List[str], int, str]
+TopPosition = Tuple[int, int, int, int]
+PackedTopics = Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
 
 
 class SearchEngine:
 
-    IT_STOP_WORDS: Set[int] = set(get_stop_words('it'))
-    EN_STOP_WORDS: Set[int] = set(get_stop_words('en'))
+    SCORING_MODE: str = SCORING_MODE
+    MAX_QUERY_WORDS: int = MAX_QUERY_WORDS
+    MAX_NGRAM_SIZE: int = MAX_NGRAM_SIZE
+    SHORTLIST: bool = SEARCH_SHORTLIST
+    SHORTLIST_MIN_SCORE: int = SHORTLIST_MIN_SCORE
 
     @classmethod
-    def generate_sorted_topics(
-        cls, episodes: Dict[str, Episode], text: str
+    def generate_top_topics(
+        cls,
+        episodes: Dict[str, Episode],
+        text: str,
+        n: int,
+        m: int,
+        index: Optional["TopicIndex"] = None,
+        shortlist: Optional[bool] = None
     ) -> Tuple[List[TopicSnippet], str, int]:
-        episodes_topic = list()
+        """
+        First n topics by score, the shorter label first on ties, having max score >= m and score >= 75% of the
+        best score, selected with a bounded heap instead of sorting every scored topic.
+
+        With an index every topic is scored in one batch. With the shortlist (SHORTLIST unless given) only the
+        topics sharing a trigram with the query are, which can change the results: a topic tying for the best
+        score may share none. When the best shortlisted score is below SHORTLIST_MIN_SCORE every topic is scored.
+        """
+        shortlist = cls.SHORTLIST if shortlist is None else shortlist
+        normalized_text = cls.normalize_query(text)
+        query = cls.query_combinations(normalized_text)
+
+        if index is None or not len(index):
+            top_topics, max_score = cls.select_top_topics(
+                (cls.score_topic(ep.episode_id, topic, query) for ep in episodes.values() for topic in ep.topics),
+                n, m
+            )
+            return top_topics, normalized_text, max_score
+
+        top_positions, max_score = cls.select_top_positions(index, query, normalized_text, n, m, shortlist)
+        if shortlist and (max_score is None or max_score < cls.SHORTLIST_MIN_SCORE):
+            top_positions, max_score = cls.select_top_positions(index, query, normalized_text, n, m, False)
+
+        return cls.snippets_from_positions(index, top_positions, query[2]), normalized_text, max_score
+
+    @classmethod
+    def select_top_positions(
+        cls,
+        index: "TopicIndex",
+        query: QueryCombinations,
+        normalized_text: str,
+        n: int,
+        m: int,
+        shortlist: bool
+    ) -> Tuple[List[TopPosition], Optional[int]]:
+        """
+        Index positions of the first n topics passing the search filters, with their scores and label length.
+        Max score is None when the shortlist is empty.
+        """
+        positions = index.candidates(normalized_text) if shortlist else np.arange(len(index))
+        if not len(positions):
+            return [], None
+
+        match_scores, max_scores = cls.batch_score(index, query, positions)
+        max_score = int(match_scores.max())
+
+        survivors = np.flatnonzero((max_scores >= m) & (match_scores >= max_score * .75))
+        survivor_positions = positions[survivors].tolist()
+        survivor_scores = match_scores[survivors].tolist()
+        survivor_max_scores = max_scores[survivors].tolist()
+        survivor_lengths = index.packed()[5][positions[survivors]].tolist()
+        # survivors are in scan order, so their rank breaks ties like the stable sort does
+        top = heapq.nsmallest(
+            n, range(len(survivors)), key=lambda i: (-survivor_scores[i], survivor_lengths[i], i)
+        )
+
+        return [
+            (survivor_positions[i], survivor_scores[i], survivor_max_scores[i], survivor_lengths[i]) for i in top
+        ], max_score
+
+    @staticmethod
+    def snippets_from_positions(
+        index: "TopicIndex", top_positions: List[TopPosition], technique: str
+    ) -> List[TopicSnippet]:
+        top_topics = list()
+        for position, match_score, max_score, _ in top_positions:
+            episode_id, topic = index.topic(position)
+            top_topics.append((episode_id, topic, match_score, technique, topic.url, max_score))
+        return top_topics
+
+    @staticmethod
+    def select_top_topics(scored_topics: Iterable[TopicSnippet], n: int, m: int) -> Tuple[List[TopicSnippet], int]:
+        heap: List[Tuple[int, int, int, TopicSnippet]] = list()
+        max_score = None
+        for seq, tpl in enumerate(scored_topics):
+            if max_score is None or tpl[2] > max_score:
+                max_score = tpl[2]
+            # the best score only grows, whatever is under its 75% now won't make it to the end
+            if tpl[5] < m or tpl[2] < max_score * .75:
+                continue
+            entry = (tpl[2], -len(tpl[1].label), -seq, tpl)
+            if len(heap) < n:
+                heapq.heappush(heap, entry)
+            elif entry[:3] > heap[0][:3]:
+                heapq.heapreplace(heap, entry)
+
+        if max_score is None:
+            raise ValueError("No topics to select from")
+
+        return [entry[3] for entry in sorted(heap, key=lambda e: e[:3], reverse=True) if entry[0] >= max_score * .75], max_score
+
+    @classmethod
+    def normalize_query(cls, text: str) -> str:
         normalized_text = cls.normalize_string(text)
 
         if not normalized_text:
             raise ValueNotValid("Il testo inviato non contiene caratteri alfanumerici né parole significative, nessun risultato ottenuto.")
 
-        for ep in episodes.values():
-            episodes_topic.extend(cls.scan_episode(ep, normalized_text))
-
-        max_score = max(episodes_topic, key=lambda x: x[2])[2]
-
-        return (
-            sorted(episodes_topic, key=lambda x: (-x[2], len(x[1].label))),
-            normalized_text,
-            max_score
-        )
+        return normalized_text
 
     @classmethod
     def normalize_string(cls, s: str) -> str:
-        s = unidecode(s.lower())
-        s = re.sub("[^A-Za-z0-9 ]+", " ", s)
-        for word in s.split(" "):
-            if word in cls.EN_STOP_WORDS or word in cls.IT_STOP_WORDS:
-                s = re.sub(r"\b{}\b".format(word), "", s)
-        s = re.sub("[ ]+", " ", s).strip()
+        return normalize_text(s)
 
-        return s
+    @classmethod
+    def query_combinations(cls, normalized_text: str, mode: Optional[str] = None) -> QueryCombinations:
+        """
+        Word groups of the query to compare against each topic word, and the number of query words used.
+
+        "combinations" joins every subset of the query words, that is 2^k - 1 groups for k words.
+        "bounded" joins only contiguous runs of up to MAX_NGRAM_SIZE words among the first MAX_QUERY_WORDS,
+        so a query never costs more than MAX_QUERY_WORDS * MAX_NGRAM_SIZE groups per topic word.
+        The two modes are identical for queries up to two words. Up to MAX_QUERY_WORDS words the bounded groups are
+        a subset of the combinations ones, so every topic scores at most what it scores with combinations.
+        """
+        mode = mode or cls.SCORING_MODE
+        text_input_words = tokenize(normalized_text)
+
+        if mode == "combinations":
+            combs = list()
+            for ngram in range(1, len(text_input_words)+1):
+                for combination in combinations(text_input_words, ngram):
+                    combs.append("".join(combination))
+            return combs, len(text_input_words), "mean_most_similar_combo"
+        elif mode == "bounded":
+            text_input_words = text_input_words[:cls.MAX_QUERY_WORDS]
+            combs = list()
+            for ngram in range(1, min(cls.MAX_NGRAM_SIZE, len(text_input_words))+1):
+                for i in range(len(text_input_words) - ngram + 1):
+                    combs.append("".join(text_input_words[i:i+ngram]))
+            return combs, len(text_input_words), "mean_most_similar_ngram"
+        else:
+            raise ValueError(f"Scoring mode {mode} not valid, choose one between (combinations, bounded)")
 
     @classmethod
     def compare_strings(cls, descr: str, text_input: str) -> Tuple[int, str, int]:
+        return cls.compare_tokens(tokenize(descr), cls.query_combinations(text_input))
 
-        max_list = list()
-        text_input_words = text_input.split(" ")
-        combs = list()
-        for ngram in range(1, len(text_input_words)+1):
-            for combination in combinations(text_input_words, ngram):
-                combs.append(combination)
+    @classmethod
+    def compare_tokens(cls, descr_words: List[str], query: QueryCombinations) -> Tuple[int, str, int]:
+        combs, n_words, technique = query
 
+        max_list = list()
         for word_inputs in combs:
-            max_list.append(max([fuzz.ratio("".join(word_inputs), w) for w in descr.split(" ")]))
+            max_list.append(max([fuzz.ratio(word_inputs, w) for w in descr_words]))
 
-        return int(sum(max_list) / len(text_input_words)), "mean_most_similar_combo", max(max_list)
+        return int(sum(max_list) / n_words), technique, max(max_list)
 
+    @classmethod
+    def batch_score(
+        cls, index: "TopicIndex", query: QueryCombinations, positions: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same scores of compare_tokens for the topics at the given index positions, computed in one go:
+        every query group is compared once against every word of the vocabulary, then each topic
+        takes the best ratio among its own words.
+        """
+        combs, n_words, _ = query
+        words, word_lengths, token_ids, offsets, n_tokens, _ = index.packed()
+
+        distances = process.cdist(combs, words, scorer=Indel.distance, dtype=np.int32)
+        len_sums = np.add.outer(np.array([len(comb) for comb in combs]), word_lengths)
+        # rounded the same way fuzz.ratio does, so scores are identical to the per-topic loop
+        ratios = np.rint(100 * ((len_sums - distances) / len_sums)).astype(np.int64)
+
+        # tokens of the selected topics laid out contiguously, one reduceat segment per topic
+        lengths = n_tokens[positions]
+        starts = np.cumsum(lengths) - lengths
+        flat_tokens = np.repeat(offsets[positions] - starts, lengths) + np.arange(lengths.sum())
+        best_ratios = np.maximum.reduceat(ratios[:, token_ids[flat_tokens]], starts, axis=1)
+
+        return (best_ratios.sum(axis=0) / n_words).astype(np.int64), best_ratios.max(axis=0)
 
     @classmethod
-    def scan_episode(cls, episode: Episode, normalized_text: str) -> List[TopicSnippet]:
-        ls_res = list()
-        for topic in episode.topics:
-            match_score, technique, max_score = cls.compare_strings(
-                cls.normalize_string(topic.label), normalized_text
-            )
-            ls_res.append(
-                (episode.episode_id, topic, match_score, technique, topic.url, max_score)
-            )
-        return ls_res
+    def score_topic(cls, episode_id: str, topic: EpisodeTopic, query: QueryCombinations) -> TopicSnippet:
+        match_score, technique, max_score = cls.compare_tokens(topic.tokens, query)
+        return episode_id, topic, match_score, technique, topic.url, max_score
+
+    @classmethod
+    def scan_episode(
+        cls, episode: Episode, normalized_text: str, query: Optional[QueryCombinations] = None
+    ) -> List[TopicSnippet]:
+        query = query or cls.query_combinations(normalized_text)
+        return [cls.score_topic(episode.episode_id, topic, query) for topic in episode.topics]
+
+
+class TopicIndex:
+    """
+    Inverted index from character trigrams of normalized topic words to topic postings,
+    used to shortlist the topics worth fuzzy scoring for a query.
+    It also keeps topic words packed as ids over a shared vocabulary for SearchEngine.batch_score.
+    """
+
+    def __init__(self) -> None:
+        self._topics: List[Tuple[str, EpisodeTopic]] = list()
+        self._postings: Dict[str, Set[int]] = defaultdict(set)
+        self._episode_ids: Set[str] = set()
+        self._vocabulary: Dict[str, int] = dict()
+        self._token_ids: List[int] = list()
+        self._offsets: List[int] = list()
+        self._label_lengths: List[int] = list()
+        self._packed: Optional[PackedTopics] = None
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._topics)
+
+    @staticmethod
+    def word_trigrams(word: str) -> Set[str]:
+        padded = f" {word} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @classmethod
+    def text_trigrams(cls, normalized_text: str) -> Set[str]:
+        words = normalized_text.split(" ")
+        trigrams = set()
+        for word in words:
+            trigrams |= cls.word_trigrams(word)
+        if len(words) > 1:
+            # the scorer also joins query words together, e.g. "celeste pedone" -> "celestepedone"
+            trigrams |= cls.word_trigrams("".join(words))
+        return trigrams
+
+    def add_episodes(self, episodes: Dict[str, Episode]) -> None:
+        with self._lock:
+            for episode in episodes.values():
+                if episode.episode_id in self._episode_ids:
+                    continue
+                self._episode_ids.add(episode.episode_id)
+                for topic in episode.topics:
+                    self._add_topic(episode.episode_id, topic)
+            self._packed = None
+
+    def add_topics(self, topics: List[Tuple[str, EpisodeTopic]]) -> None:
+        with self._lock:
+            for episode_id, topic in topics:
+                self._episode_ids.add(episode_id)
+                self._add_topic(episode_id, topic)
+            self._packed = None
+
+    def _add_topic(self, episode_id: str, topic: EpisodeTopic) -> None:
+        position = len(self._topics)
+        self._topics.append((episode_id, topic))
+        self._offsets.append(len(self._token_ids))
+        self._label_lengths.append(len(topic.label))
+        for word in topic.tokens:
+            self._token_ids.append(self._vocabulary.setdefault(word, len(self._vocabulary)))
+            for trigram in self.word_trigrams(word):
+                self._postings[trigram].add(position)
+
+    def topic(self, position: int) -> Tuple[str, EpisodeTopic]:
+        return self._topics[position]
+
+    def topics_slice(self, start: int, end: int) -> List[Tuple[str, EpisodeTopic]]:
+        with self._lock:
+            return self._topics[start:end]
+
+    def candidates(self, normalized_text: str) -> np.ndarray:
+        positions: Set[int] = set()
+        with self._lock:
+            for trigram in self.text_trigrams(normalized_text):
+                positions |= self._postings.get(trigram, set())
+        # sorting positions keeps the same topic order of a full scan, so ties are broken the same way
+        return np.array(sorted(positions), dtype=np.int64)
+
+    def packed(self) -> PackedTopics:
+        with self._lock:
+            if self._packed is None:
+                words = list(self._vocabulary)
+                offsets = np.array(self._offsets, dtype=np.int64)
+                token_ids = np.array(self._token_ids, dtype=np.int64)
+                self._packed = (
+                    words,
+                    np.array([len(word) for word in words], dtype=np.int64),
+                    token_ids,
+                    offsets,
+                    np.diff(np.append(offsets, len(token_ids))),
+                    np.array(self._label_lengths, dtype=np.int64)
+                )
+            return self._packed
+
+
+# state of a ShardedSearchPool worker process, set once by init_search_shard
+_shard_index: Optional[TopicIndex] = None
+_shard_start: int = 0
+
+
+def init_search_shard(start: int, topics: List[Tuple[str, EpisodeTopic]]) -> None:
+    global _shard_index, _shard_start
+    _shard_index = TopicIndex()
+    _shard_index.add_topics(topics)
+    _shard_start = start
+
+
+def search_shard(normalized_text: str, n: int, m: int, shortlist: bool) -> Tuple[List[TopPosition], Optional[int]]:
+    assert _shard_index is not None  # for mypy, set by the pool initializer
+    if not len(_shard_index):
+        return [], None
+    query = SearchEngine.query_combinations(normalized_text)
+    top_positions, max_score = SearchEngine.select_top_positions(_shard_index, query, normalized_text, n, m, shortlist)
+    return [(_shard_start + position, *scores) for position, *scores in top_positions], max_score
+
+
+class ShardedSearchPool:
+    """
+    Runs SearchEngine.select_top_positions on contiguous shards of a TopicIndex, each one held by its own
+    worker process, so only the query goes through the pipe and one heavy search doesn't hold the GIL.
+    Every shard returns its own top n, the parent merges them against the overall best score.
+    A shard replaced by sync is shut down only once the searches that were already using it are done.
+    """
+
+    def __init__(self, n_shards: int) -> None:
+        self.n_shards = max(1, n_shards)
+        self._shards: List[Tuple[int, int, ProcessPoolExecutor]] = list()
+        self._lock = Lock()
+        # executor -> searches using it, and the replaced executors still used by some search
+        self._in_flight: Dict[ProcessPoolExecutor, int] = defaultdict(int)
+        self._retired: Set[ProcessPoolExecutor] = set()
+        # spawn instead of fork, the bot is already running threads when the pool starts
+        self._mp_context = multiprocessing.get_context("spawn")
+
+    def _start_shard(self, index: TopicIndex, start: int, end: int) -> Tuple[int, int, ProcessPoolExecutor]:
+        executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self._mp_context,
+            initializer=init_search_shard,
+            initargs=(start, index.topics_slice(start, end))
+        )
+        return start, end, executor
+
+    def _retire(self, executor: ProcessPoolExecutor) -> None:
+        # called holding _lock
+        if self._in_flight.get(executor):
+            self._retired.add(executor)
+        else:
+            executor.shutdown(wait=False)
+
+    def _acquire(self) -> List[ProcessPoolExecutor]:
+        with self._lock:
+            executors = [executor for _, _, executor in self._shards]
+            for executor in executors:
+                self._in_flight[executor] += 1
+        return executors
+
+    def _release(self, executors: List[ProcessPoolExecutor]) -> None:
+        with self._lock:
+            for executor in executors:
+                self._in_flight[executor] -= 1
+                if not self._in_flight[executor]:
+                    del self._in_flight[executor]
+                    if executor in self._retired:
+                        self._retired.discard(executor)
+                        executor.shutdown(wait=False)
+
+    def covers(self, index: TopicIndex) -> bool:
+        """True if the shards hold every topic of index, until then searches have to run in the parent."""
+        with self._lock:
+            return bool(self._shards) and self._shards[-1][1] == len(index)
+
+    def sync(self, index: TopicIndex) -> None:
+        with self._lock:
+            if self._shards and self._shards[-1][1] - self._shards[-1][0] > 2 * len(index) / self.n_shards:
+                # the last shard took too many of the new episodes, spread them again
+                for _, _, executor in self._shards:
+                    self._retire(executor)
+                self._shards = list()
+
+            if not self._shards:
+                shard_size = -(-len(index) // self.n_shards)
+                for start in range(0, len(index), max(1, shard_size)):
+                    self._shards.append(self._start_shard(index, start, min(start + shard_size, len(index))))
+                logger.info(f"Search pool started with {len(self._shards)} shards over {len(index)} topics.")
+            elif self._shards[-1][1] < len(index):
+                # new episodes are always appended to the index, so only the last shard has to be reloaded
+                start, _, old_executor = self._shards[-1]
+                self._shards[-1] = self._start_shard(index, start, len(index))
+                self._retire(old_executor)
+                logger.info(f"Search pool last shard reloaded with topics from {start} to {len(index)}.")
+
+    def generate_top_topics(
+        self, index: TopicIndex, normalized_text: str, n: int, m: int, shortlist: Optional[bool] = None
+    ) -> Tuple[List[TopicSnippet], str, int]:
+        shortlist = SearchEngine.SHORTLIST if shortlist is None else shortlist
+        executors = self._acquire()
+        try:
+            results = [
+                future.result()
+                for future in [executor.submit(search_shard, normalized_text, n, m, shortlist) for executor in executors]
+            ]
+        finally:
+            self._release(executors)
+
+        shard_max_scores = [max_score for _, max_score in results if max_score is not None]
+        if shortlist and (not shard_max_scores or max(shard_max_scores) < SearchEngine.SHORTLIST_MIN_SCORE):
+            # same fallback of SearchEngine.generate_top_topics
+            return self.generate_top_topics(index, normalized_text, n, m, False)
+        if not shard_max_scores:
+            raise ValueError("No topics to select from")
+        max_score = max(shard_max_scores)
+
+        merged = [
+            top_position for top_positions, _ in results for top_position in top_positions
+            if top_position[1] >= max_score * .75
+        ]
+        # global positions are in scan order, as the serial path they break ties after score and label length
+        top_positions = heapq.nsmallest(n, merged, key=lambda x: (-x[1], x[3], x[0]))
+        technique = SearchEngine.query_combinations(normalized_text)[2]
+
+        return SearchEngine.snippets_from_positions(index, top_positions, technique), normalized_text, max_score
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for _, _, executor in self._shards:
+                self._retire(executor)
+            self._shards = list()
 
 
 class EpisodeHandler:
@@ -100,23 +481,117 @@ class EpisodeHandler:
         self.client = client
         self.show = show
         self.word_counter = word_counter
+        self.topic_index = TopicIndex()
+        self.query_cache = LRUCache(QUERY_CACHE_SIZE)
+        self.search_pool: Optional[ShardedSearchPool] = (
+            ShardedSearchPool(SEARCH_WORKERS) if SEARCH_EXECUTION_MODE == "process_pool" else None
+        )
+        self.host_maps: Dict[str, str] = dict()
+        self.host_maps_generation = -1
+        self.ingestion: Optional[Thread] = None
 
     @Cacher.cache_decorator
     def collect_episodes(self) -> Dict[str, Episode]:
+        if INGESTION_MODE == "async":
+            return asyncio.run(self.ingest_episodes())
         episodes = self.client.get_show_episodes(self.show.show_id)
         return self.process_raw_episodes(episodes)
 
     def add_episodes_to_show(self) -> None:
-        self.show.set_episodes = self.collect_episodes()
+        # the async ingestion already added what it streamed, add only the rest (e.g. a cache hit)
+        episodes = self.collect_episodes()
+        self.show.set_episodes = {
+            episode_id: episode for episode_id, episode in episodes.items() if episode_id not in self.show.episodes
+        }
+        self.index_episodes(self.show.episodes)
+
+    def start_ingestion(self) -> None:
+        """Load the catalogue into show, the async ingestion runs in the background so the bot answers meanwhile."""
+        if INGESTION_MODE == "async":
+            self.ingestion = Thread(target=self.add_episodes_to_show, name="ingestion", daemon=True)
+            self.ingestion.start()
+        else:
+            self.add_episodes_to_show()
+
+    def ingesting(self) -> bool:
+        return self.ingestion is not None and self.ingestion.is_alive()
+
+    async def ingest_episodes(self) -> Dict[str, Episode]:
+        """Stream the catalogue into show and index in batches, so episodes are searchable as they arrive."""
+        start = time.perf_counter()
+        episodes: Dict[str, Episode] = dict()
+        batch: Dict[str, Episode] = dict()
+        async with AsyncSpreakerAPIClient(self.client.token, self.client.max_in_flight) as client:
+            pages = client.iter_show_episode_pages(self.show.show_id)
+            async for episode in self.build_episodes(self.describe_episodes(client, pages)):
+                batch[episode.episode_id] = episode
+                if len(batch) >= INGESTION_BATCH_SIZE:
+                    self.show.set_episodes = batch
+                    self.index_episodes(batch, sync_pool=False)
+                    episodes.update(batch)
+                    batch = dict()
+        if batch:
+            self.show.set_episodes = batch
+            self.index_episodes(batch, sync_pool=False)
+            episodes.update(batch)
+        # the shards are loaded once, meanwhile searches run in this process
+        if self.search_pool is not None:
+            self.search_pool.sync(self.topic_index)
+        logger.info(f"Ingested {len(episodes)} episodes in {time.perf_counter() - start:.2f}s")
+        return episodes
 
-    def process_raw_episodes(self, raw_episodes: List[Dict]) -> Dict[str, Episode]:
-        return {ep["episode_id"]: self.convert_raw_ep(ep) for ep in raw_episodes}
+    @staticmethod
+    async def describe_episodes(
+        client: AsyncSpreakerAPIClient, pages: AsyncIterator[List[Dict]]
+    ) -> AsyncIterator[Tuple[Dict, Dict]]:
+        """Start the description fetches of a page as soon as it arrives, yielding (raw episode, info) in feed order."""
+        async def describe(ep: Dict) -> Tuple[Dict, Dict]:
+            return ep, await client.get_episode_info(ep["episode_id"])
+
+        pending: deque = deque()
+        try:
+            async for page in pages:
+                pending.extend(asyncio.ensure_future(describe(ep)) for ep in page)
+                while pending and pending[0].done():
+                    yield pending.popleft().result()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def build_episodes(self, described: AsyncIterator[Tuple[Dict, Dict]]) -> AsyncIterator[Episode]:
+        async for ep, episode_info in described:
+            yield self.convert_raw_ep(ep, episode_info)
+
+    def index_episodes(self, episodes: Dict[str, Episode], sync_pool: bool = True) -> None:
+        self.topic_index.add_episodes(episodes)
+        if self.search_pool is not None and sync_pool:
+            self.search_pool.sync(self.topic_index)
+        # only now, a search run between set_episodes and here would cache a result missing the new topics
+        self.show.bump_generation()
+        self.refresh_host_maps()
+
+    def close(self) -> None:
+        if self.search_pool is not None:
+            self.search_pool.shutdown()
+        self.client.close()
 
-    def convert_raw_ep(self, ep: Dict) -> Episode:
+    def process_raw_episodes(self, raw_episodes: List[Dict]) -> Dict[str, Episode]:
+        start = time.perf_counter()
+        episodes_info = self.client.get_episodes_info([ep["episode_id"] for ep in raw_episodes])
+        episodes = {
+            ep["episode_id"]: self.convert_raw_ep(ep, episodes_info[ep["episode_id"]]) for ep in raw_episodes
+        }
+        logger.info(f"Ingested {len(episodes)} episodes in {time.perf_counter() - start:.2f}s")
+        logger.info(f"API client stats: {self.client.stats()}")
+        return episodes
+
+    def convert_raw_ep(self, ep: Dict, episode_info: Optional[Dict] = None) -> Episode:
         ep_id = ep["episode_id"]
-        ep["description"] = self.client.get_episode_info(ep_id)["response"]["episode"][
-            "description"
-        ]
+        if episode_info is None:
+            episode_info = self.client.get_episode_info(ep_id)
+        ep["description"] = episode_info["response"]["episode"]["description"]
         episode = Episode(
             ep["episode_id"],
             ep["title"],
@@ -144,18 +619,43 @@ class EpisodeHandler:
     def search_text_in_episodes(
         self, text: str, n: int, m: int, is_admin: bool = False
     ) -> Tuple[str, str]:
-        sorted_tuple_episodes, normalized_text, max_score = SearchEngine.generate_sorted_topics(
-            self.show.episodes, text
-        )
+        normalized_text = SearchEngine.normalize_query(text)
         if not is_admin:
             self.word_counter.add_word(normalized_text)
 
-        filter_episodes = [tpl for tpl in sorted_tuple_episodes if tpl[5] >= m and tpl[2] >= max_score * .75][:n]
+        # the show generation in the key makes entries cached before new episodes never match again
+        cache_key = (normalized_text, n, m, is_admin, self.show.generation)
+        message = self.query_cache.get(cache_key)
+        if message is None:
+            message = self.compute_search_response(normalized_text, n, m, is_admin)
+            self.query_cache.put(cache_key, message)
+
+        return message, text
+
+    def compute_search_response(self, normalized_text: str, n: int, m: int, is_admin: bool) -> str:
+        if not len(self.show.episodes):
+            # the background ingestion didn't add the first batch yet
+            return TextRepo.MSG_EPISODES_LOADING if self.ingesting() else TextRepo.MSG_NO_RES
+
+        filter_episodes, _, max_score = self.generate_top_topics(normalized_text, n, m)
+
+        if not len(filter_episodes) and len(self.topic_index) and SearchEngine.SHORTLIST:
+            # nothing good enough among the shortlisted topics, double check with the whole index
+            filter_episodes, _, max_score = self.generate_top_topics(normalized_text, n, m, shortlist=False)
 
         if len(filter_episodes):
-            return self.format_response(filter_episodes, is_admin), text
+            return self.format_response(filter_episodes, is_admin)
         else:
-            return TextRepo.MSG_NO_RES, text
+            return TextRepo.MSG_NO_RES
+
+    def generate_top_topics(
+        self, normalized_text: str, n: int, m: int, shortlist: Optional[bool] = None
+    ) -> Tuple[List[TopicSnippet], str, int]:
+        if self.search_pool is not None and len(self.topic_index) and self.search_pool.covers(self.topic_index):
+            return self.search_pool.generate_top_topics(self.topic_index, normalized_text, n, m, shortlist)
+        return SearchEngine.generate_top_topics(
+            self.show.episodes, normalized_text, n, m, self.topic_index, shortlist
+        )
 
     def format_response(
         self, first_eps_sorted: List[TopicSnippet], admin_req: bool
@@ -169,8 +669,8 @@ class EpisodeHandler:
             topic_url = tuple_[4]
             topic_label = tuple_[1].label if topic_url != "@PowerPizzaSearchBot" else tuple_[1].label + " <i>(hey, that's me!)</i>"
             max_score = tuple_[5]
-            episode_line = self.format_episode_title_line(ep.site_url, ep.title, ep.number, ep.sub_number)
-            date = self.convert_to_italian_date_format(ep.published_at)
+            episode_line = self.render_title_line(ep)
+            date = self.render_date(ep)
             message += TextRepo.MSG_RESPONSE.format(
                 i, score, topic_url, topic_label, episode_line, date
             )
@@ -183,36 +683,48 @@ class EpisodeHandler:
         return message
 
     def retrieve_new_episode(self, *args) -> None:
+        """
+        Add the episodes published since the last poll, usually with one conditional request: a 304 when the feed
+        didn't change, otherwise a page of the POLL_PAGE_SIZE newest episodes.
+
+        The Spreaker episodes endpoint only takes limit, paging and sorting, it can't be asked for the episodes
+        published after a date, so the published_at bound is applied here on the page. Only when every episode of
+        the page is new (the bot missed more than a page of episodes, e.g. it was down for weeks) the page is asked
+        again twice as big, log2(gap / POLL_PAGE_SIZE) more requests. The regular hourly poll never gets there.
+        """
+        if self.ingesting():
+            logger.info("Still ingesting the catalogue, new episodes will be checked next time.")
+            return
         logger.info("Gonna check if there are new episodes I missed.")
-        keep_checking = True
-        n_last_episodes = 2
-        while keep_checking:
-            last_episodes = self.client.get_last_n_episode(
-                self.show.show_id, n_last_episodes
-            )
-
-            # equivalent to a take while there's no new episoded, to refactor
-            if all(
-                last_ep["episode_id"] in self.show.get_episode_ids()
-                for last_ep in last_episodes
-            ):  # if we already have last n episodes
-                keep_checking = False
+        known_ids = self.show.get_episode_ids()
+        last_published_at = max((ep.published_at for ep in self.show.episodes.values()), default="")
+        page_size = POLL_PAGE_SIZE
+        while True:
+            last_episodes = self.client.get_last_n_episode(self.show.show_id, page_size)
+            if last_episodes is None:  # 304, the feed didn't change
                 logger.info("Cache is already up to date.")
-            elif all(
-                last_ep["episode_id"] not in self.show.get_episode_ids()
-                for last_ep in last_episodes
-            ):  # if we have none, check one more
-                n_last_episodes += 1
-            else:  # we have all but the last one, we gucci
-                logger.info(f"Adding {n_last_episodes-1} new episodes!")
-
-                new_episodes = last_episodes[:-1]
-                procd_episodes = self.process_raw_episodes(new_episodes)
-
-                self.show.set_episodes = procd_episodes
-                Cacher.cache_updater(procd_episodes)
-
-                keep_checking = False
+                return
+            # newest first, so take while episodes are unknown and not older than what we have
+            new_episodes = list(takewhile(
+                lambda ep: ep["episode_id"] not in known_ids and ep["published_at"] >= last_published_at,
+                last_episodes
+            ))
+            # the whole page is new and there may be more, the gap is bigger than a page
+            if len(new_episodes) == len(last_episodes) == page_size:
+                page_size *= 2
+                continue
+            break
+
+        if new_episodes:
+            logger.info(f"Adding {len(new_episodes)} new episodes!")
+            procd_episodes = self.process_raw_episodes(new_episodes)
+
+            self.show.set_episodes = procd_episodes
+            self.index_episodes(procd_episodes)
+            Cacher.cache_updater(procd_episodes)
+        else:
+            logger.info("Cache is already up to date.")
+        self.client.commit_validators()
 
     def save_searches(self, *args):
         return self.word_counter.dump_counter()
@@ -225,13 +737,24 @@ class EpisodeHandler:
         return last_ep.number
 
     def format_single_episode(self, ep: Episode) -> str:
+        return ep.memoized("single_episode", lambda: self.render_single_episode(ep))
+
+    def render_single_episode(self, ep: Episode) -> str:
         title_message = f"Episodio {ep.number}{ep.sub_number}: {ep.title_str}"
         title_message_link = f"<a href='{ep.site_url}'>{title_message}</a>"
-        msg = title_message_link + f" ({self.convert_to_italian_date_format(ep.published_at)})\n\n"
+        msg = title_message_link + f" ({self.render_date(ep)})\n\n"
         msg_description = f"{ep.description_raw}\n--------------------------------\n"
 
         return msg + msg_description.replace('>', '&gt;').replace('<', '&lt;')
 
+    def render_date(self, ep: Episode) -> str:
+        return ep.memoized("date", lambda: self.convert_to_italian_date_format(ep.published_at))
+
+    def render_title_line(self, ep: Episode) -> str:
+        return ep.memoized(
+            "title_line", lambda: self.format_episode_title_line(ep.site_url, ep.title, ep.number, ep.sub_number)
+        )
+
     def get_episode(self, number_ep: int, subletter: str) -> str:
         episode = self.show.get_episode_by_number_and_subletter(number_ep, subletter)
         if episode is None:
@@ -256,7 +779,24 @@ class EpisodeHandler:
         episodes = self.show.get_not_numbered_episodes()
         return self.format_single_episode(random.choice(episodes))
 
+    HOST_MAP_SORT_ORDERS = ("abc", "frequency", "first_appear")
+
     def get_host_map(self, sort_order:str = "abc") -> str:
+        if sort_order not in self.HOST_MAP_SORT_ORDERS:
+            sort_order = "frequency"
+        if self.host_maps_generation != self.show.generation:
+            self.refresh_host_maps()
+        return self.host_maps[sort_order]
+
+    def refresh_host_maps(self) -> None:
+        """Render the host map in every order, they only change when episodes are added to the show."""
+        generation = self.show.generation
+        self.host_maps = {
+            sort_order: self.render_host_map(sort_order) for sort_order in self.HOST_MAP_SORT_ORDERS
+        }
+        self.host_maps_generation = generation
+
+    def render_host_map(self, sort_order: str) -> str:
 
         if sort_order == "frequency":
             sort_f = lambda x: (len(x[1]), max(x[1]))
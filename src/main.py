@@ -1,3 +1,4 @@
+import asyncio
 import configparser
 import json
 import logging
@@ -34,10 +35,12 @@ from support.TextRepo import TextRepo
 from model.models import SearchConfigs, Show
 from logic.logic import EpisodeHandler
 from support.configuration import SRC_FOLDER, config, LOG_FILEPATH, CACHE_FILEPATH, LIST_OF_ADMINS, MINIMUM_SCORE, CREATOR_TELEGRAM_ID
+from support.configuration import RUNTIME_MODE, SEARCH_EXECUTION_MODE
 from support.apiclient import SpreakerAPIClient
 from support.bot_support import MQBot, FacadeBot
 from support.WordCounter import WordCounter
 from support.bot_support import error_callback
+from support.async_runtime import AsyncTelegramBot, AsyncBotRuntime, WebhookBotRuntime
 from support.decorators import restricted
 
 logging.basicConfig(
@@ -61,20 +64,35 @@ def main():
     power_pizza = Show(config["POWER_PIZZA"].get("SHOW_ID"))
 
     TOKEN_BOT = config["SECRET"].get("bot_token")
-    q = mq.MessageQueue(all_burst_limit=29, all_time_limit_ms=1017)
-    request = Request(con_pool_size=8)
-    testbot = MQBot(TOKEN_BOT, request=request, mqueue=q)
-    updater = extUpdater(bot=testbot, use_context=True)
-
-    for admin in LIST_OF_ADMINS:
-        updater.bot.send_message(chat_id=admin, text=init_message_config)
+    if RUNTIME_MODE in ("asyncio", "webhook"):
+        # same handlers and jobs, registered on the runtime instead of the dispatcher
+        runtime_class = WebhookBotRuntime if RUNTIME_MODE == "webhook" else AsyncBotRuntime
+        if SEARCH_EXECUTION_MODE != "process_pool":
+            logger.warning("Searches share the GIL with the runtime workers, set EXECUTION_MODE = process_pool to run them in parallel.")
+        runtime = runtime_class(AsyncTelegramBot(TOKEN_BOT))
+        dp = runtime
+        stop_updates = runtime.stop
+
+        def send_boot_message(context):
+            for admin in LIST_OF_ADMINS:
+                context.bot.send_message(chat_id=admin, text=init_message_config)
+
+        runtime.run_once(send_boot_message, 0)
+    else:
+        q = mq.MessageQueue(all_burst_limit=29, all_time_limit_ms=1017)
+        request = Request(con_pool_size=8)
+        testbot = MQBot(TOKEN_BOT, request=request, mqueue=q)
+        updater = extUpdater(bot=testbot, use_context=True)
+        dp = updater.dispatcher
+        stop_updates = updater.stop
+
+        for admin in LIST_OF_ADMINS:
+            updater.bot.send_message(chat_id=admin, text=init_message_config)
 
     episode_handler = EpisodeHandler(client, power_pizza, WordCounter())
-    episode_handler.add_episodes_to_show()
 
     facade_bot = FacadeBot(episode_handler)
 
-    dp = updater.dispatcher
     dp.add_handler(CommandHandler("s", facade_bot.search))
     dp.add_handler(CommandHandler("top", facade_bot.set_top_results))
     dp.add_handler(CommandHandler("last", facade_bot.get_last_ep))
@@ -94,6 +112,8 @@ def main():
     dp.add_handler(CommandHandler("ncw", facade_bot.get_most_common_words, filters=Filters.user(username=CREATOR_TELEGRAM_ID)))
     dp.add_handler(CommandHandler("neps", facade_bot.get_episodes_total_n, filters=Filters.user(username=CREATOR_TELEGRAM_ID)))
     dp.add_handler(CommandHandler("qry", facade_bot.get_daily_logs, filters=Filters.user(username=CREATOR_TELEGRAM_ID)))
+    dp.add_handler(CommandHandler("qcache", facade_bot.get_query_cache_stats, filters=Filters.user(username=CREATOR_TELEGRAM_ID)))
+    dp.add_handler(CommandHandler("pstats", facade_bot.get_persistence_stats, filters=Filters.user(username=CREATOR_TELEGRAM_ID)))
     
     dp.add_handler(CommandHandler("memo", facade_bot.memo, filters=Filters.user(username=CREATOR_TELEGRAM_ID)))
 
@@ -106,12 +126,16 @@ def main():
 
     def stop_and_restart():
         logger.info("Stop and restarting bot...")
-        updater.stop()
+        stop_updates()
+        facade_bot.persistence.stop()
+        episode_handler.close()
         os.execl(sys.executable, sys.executable, *sys.argv)
 
     def kill_bot():
         logger.info("Shutting down bot...")
-        updater.stop()
+        stop_updates()
+        facade_bot.persistence.stop()
+        episode_handler.close()
 
     @restricted
     def restart(update, context):
@@ -147,9 +171,14 @@ def main():
         CommandHandler("killme", kill, filters=Filters.user(username=CREATOR_TELEGRAM_ID))
     )
 
-    updater.start_polling()
+    # with INGESTION_MODE = async the catalogue streams in while the bot already answers
+    episode_handler.start_ingestion()
 
-    updater.idle()
+    if RUNTIME_MODE in ("asyncio", "webhook"):
+        asyncio.run(runtime.run())
+    else:
+        updater.start_polling()
+        updater.idle()
 
 
 if __name__ == "__main__":
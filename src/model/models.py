@@ -7,24 +7,50 @@ from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 import re
 import logging
 
-import fuzzywuzzy.fuzz
 import phonetics
-from support.configuration import CACHE_FILEPATH, USERS_CFG_FOLDER, config, USERS_CFG_FILEPATH
-from collections import defaultdict
-from datetime import datetime
-from support.decorators import hash_chat_id
-from unidecode import unidecode
+from support.configuration import USERS_CFG_FOLDER, USERS_CFG_FILEPATH
+from datetime import datetime, timedelta
+from threading import Lock
+from support.decorators import hash_chat_id, legacy_chat_id_digest
+from support.fileio import append_lines, atomic_write_text, read_json_lines
+from support.normalization import normalize_text, tokenize
 
 logger = logging.getLogger("model.models")
 
 
 class EpisodeTopic:
-    def __init__(self, label: str, url: str) -> None:
+    def __init__(
+        self,
+        label: str,
+        url: str,
+        normalized_label: Optional[str] = None,
+        tokens: Optional[List[str]] = None
+    ) -> None:
         self.label = label
         self.url = url
+        # labels never change, so the search only needs to normalize the query
+        self.normalized_label: str = normalize_text(label) if normalized_label is None else normalized_label
+        self.tokens: List[str] = tokenize(self.normalized_label) if tokens is None else tokens
+
+    def to_dict(self) -> Dict[str, Union[str, List[str]]]:
+        return {
+            "label": self.label,
+            "url": self.url,
+            "normalized_label": self.normalized_label,
+            "tokens": self.tokens
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict):
+        return cls(data["label"], data["url"], data.get("normalized_label"), data.get("tokens"))
 
 
 class Episode:
+    # fields the rendered messages are made of, setting one of them drops what was memoized
+    RENDER_FIELDS = frozenset(
+        ["title", "published_at", "site_url", "description_raw", "number", "sub_number", "title_str"]
+    )
+
     def __init__(
         self,
         episode_id: str,
@@ -44,18 +70,63 @@ class Episode:
         self.title_str: str = self.parse_ep_title()
         self.hosts: List[str] = self.parse_hosts()
 
-    def to_dict(self) -> Dict[str, Union[str, List[Dict[str, str]]]]:
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in Episode.RENDER_FIELDS:
+            self.__dict__.pop("_render_cache", None)
+        object.__setattr__(self, name, value)
+
+    def memoized(self, key: str, factory: Callable[[], str]) -> str:
+        """Rendered text stored under key, built with factory the first time it is asked for."""
+        render_cache = self.__dict__.setdefault("_render_cache", dict())
+        if key not in render_cache:
+            render_cache[key] = factory()
+        return render_cache[key]
+
+    def to_dict(self) -> Dict[str, Union[str, List[Dict[str, Union[str, List[str]]]]]]:
         return {
             "episode_id": self.episode_id,
             "title": self.title,
             "published_at": self.published_at,
             "site_url": self.site_url,
             "description_raw": self.description_raw,
-            "topics": [
-                {"label": topic.label, "url": topic.url} for topic in self.topics
-            ]
+            "topics": [topic.to_dict() for topic in self.topics]
         }
 
+    def to_record(self) -> Tuple[str, str, str, str, str, int, str, str, str, str]:
+        return (
+            self.episode_id,
+            self.title,
+            self.published_at,
+            self.site_url,
+            self.description_raw,
+            # Show gives unnumbered episodes a negative placeholder, what was parsed is -1
+            self.number if self.number >= 0 else -1,
+            self.sub_number,
+            self.title_str,
+            json.dumps(self.hosts),
+            json.dumps([topic.to_dict() for topic in self.topics])
+        )
+
+    @classmethod
+    def from_record(cls, record: Tuple[str, str, str, str, str, int, str, str, str, str]):
+        """Rebuild an episode from to_record output, already parsed fields are taken as they are."""
+        new_instance = cls.__new__(cls)
+        (
+            new_instance.episode_id,
+            new_instance.title,
+            new_instance.published_at,
+            new_instance.site_url,
+            new_instance.description_raw,
+            new_instance.number,
+            new_instance.sub_number,
+            new_instance.title_str,
+            hosts,
+            topics
+        ) = record
+        new_instance.hosts = json.loads(hosts)
+        new_instance.topics = [EpisodeTopic.from_dict(topic) for topic in json.loads(topics)]
+        return new_instance
+
     @classmethod
     def from_dict(cls, data: Dict):
         new_instance = cls(
@@ -65,7 +136,7 @@ class Episode:
             data["site_url"],
             data["description_raw"],
         )
-        new_instance.topics = [EpisodeTopic(topic["label"], topic["url"]) for topic in data["topics"]]
+        new_instance.topics = [EpisodeTopic.from_dict(topic) for topic in data["topics"]]
         return new_instance
 
     def populate_topics(self) -> None:
@@ -143,9 +214,18 @@ class Show:
         self.show_id = show_id
         self._episodes: Dict[str, Episode] = dict()
         self.vacant_episode_index = -1
+        # bumped once episodes are added and indexed, anything derived from the catalogue can check it to know if stale
+        self.generation = 0
         self.hosts_eps_map = defaultdict(
             lambda: {'names': Counter(), 'episodes': set()}
         )
+        # secondary indexes kept in sync by set_episodes, so that lookups don't scan the catalogue
+        self._episode_list: List[Episode] = []
+        self._episode_positions: Dict[str, int] = dict()
+        self._episodes_by_number: Dict[int, List[Episode]] = defaultdict(list)
+        self._episode_by_number_sub: Dict[Tuple[int, str], Episode] = dict()
+        self._not_numbered_episodes: List[Episode] = []
+        self._last_episode: Optional[Episode] = None
 
     @property
     def episodes(self) -> Dict[str, Episode]:
@@ -159,9 +239,49 @@ class Show:
             if episode.number == -1:
                 episode.number = self.vacant_episode_index
                 self.vacant_episode_index -= 1
+            old_episode = self._episodes.get(episode.episode_id)
+            if old_episode is not None:
+                self._unindex_episode(old_episode)
             self._episodes[episode.episode_id] = episode
+            self._index_episode(episode)
             self.set_hosts_from_episode(episode)
 
+    def bump_generation(self) -> None:
+        """Mark what was derived from the catalogue as stale, call it once the new episodes are searchable."""
+        self.generation += 1
+
+    def _index_episode(self, episode: Episode) -> None:
+        if episode.episode_id in self._episode_positions:
+            self._episode_list[self._episode_positions[episode.episode_id]] = episode
+        else:
+            self._episode_positions[episode.episode_id] = len(self._episode_list)
+            self._episode_list.append(episode)
+        self._episodes_by_number[episode.number].append(episode)
+        # first one added wins, like the linear scan used to
+        self._episode_by_number_sub.setdefault((episode.number, episode.sub_number), episode)
+        if episode.number < 0:
+            self._not_numbered_episodes.append(episode)
+        elif episode.number > 0 and (self._last_episode is None or episode.number > self._last_episode.number):
+            self._last_episode = episode
+
+    def _unindex_episode(self, episode: Episode) -> None:
+        # the slot in _episode_list is overwritten by _index_episode
+        same_number = self._episodes_by_number[episode.number]
+        same_number.remove(episode)
+        if not same_number:
+            del self._episodes_by_number[episode.number]
+        key = (episode.number, episode.sub_number)
+        if self._episode_by_number_sub.get(key) is episode:
+            del self._episode_by_number_sub[key]
+            other = next((ep for ep in same_number if ep.sub_number == episode.sub_number), None)
+            if other is not None:
+                self._episode_by_number_sub[key] = other
+        if episode.number < 0:
+            self._not_numbered_episodes.remove(episode)
+        if self._last_episode is episode:
+            numbered = [n for n in self._episodes_by_number if n > 0]
+            self._last_episode = self._episodes_by_number[max(numbered)][0] if numbered else None
+
     def get_episode(self, episode_id: str) -> Episode:
         return self._episodes[episode_id]
 
@@ -169,22 +289,21 @@ class Show:
         return set(self._episodes.keys())
 
     def get_last_episode(self) -> Episode:
-        return max([ep for ep in self._episodes.values() if ep.number > 0], key=lambda x: x.number)
+        if self._last_episode is None:
+            raise ValueError("No numbered episodes")
+        return self._last_episode
 
-    def get_episode_by_number_and_subletter(self, number: int, subletter: str) -> Episode:
-        return next(
-            filter(lambda ep: ep.number == number and ep.sub_number == subletter, self._episodes.values()),
-            None
-        )
+    def get_episode_by_number_and_subletter(self, number: int, subletter: str) -> Optional[Episode]:
+        return self._episode_by_number_sub.get((number, subletter))
 
     def get_episodes_by_number(self, number: int) -> List[Episode]:
-        return [ep for ep in self._episodes.values() if ep.number == number]
+        return self._episodes_by_number.get(number, [])
 
     def get_random_episode(self) -> Episode:
-        return self._episodes[random.choice(list(self._episodes.keys()))]
+        return random.choice(self._episode_list)
 
     def get_not_numbered_episodes(self) -> List[Episode]:
-        return list(filter(lambda ep: ep.number < 0, self._episodes.values()))
+        return self._not_numbered_episodes
 
     def set_hosts_from_episode(self, episode: Episode):
         for host in episode.hosts:
@@ -199,6 +318,8 @@ class Show:
                 logger.error(f'Errore per host {host}: {e}')
 
 class UserConfig:
+    __slots__ = ("n", "m")
+
     def __init__(self, n, m):
         self.n = n
         self.m = m
@@ -207,31 +328,89 @@ class UserConfig:
 class SearchConfigs:
 
     DATE_FORMAT = "%Y%m%dT%H%M%S"
-    _user_data: Dict[str, UserConfig] = defaultdict(lambda: UserConfig(5, 1))
+    DEFAULT_N = 5
+    DEFAULT_M = 1
+    # only chats that changed something are stored, keyed by binary digest, everyone else reads the defaults
+    _user_data: Dict[bytes, UserConfig] = dict()
+    # digest of every chat seen, customized or not, the ones using the defaults are dumped next to the configs
+    _seen_users: Set[bytes] = set()
+    SEEN_USERS_KEY = "seen_users"
+    # keys restored from backups written with the old sha1(bytes(abs(chat_id))) scheme, not yet moved to their new
+    # key, they stay in the snapshots until their chat shows up
+    _legacy_keys: Set[bytes] = set()
+    # chats whose legacy key was already looked for, cleared once every legacy key is moved
+    _legacy_checked: Set[bytes] = set()
+    LEGACY_KEY_LENGTH = 20
     DUMP_FOLDER = USERS_CFG_FOLDER
     USERS_CFG_FILEPATH = USERS_CFG_FILEPATH
+    # every set_user_cfg is appended here before being applied, dump_data folds it into a snapshot
+    JOURNAL_FILENAME = "users_cfg_journal.jsonl"
+    _lock = Lock()
+    # changed since the last snapshot
+    _dirty = False
+
+    @classmethod
+    def migrate_legacy_key(cls, chat_id: int, hashed_chat_id: bytes) -> None:
+        """
+        Move the config of chat_id from its legacy key, looked for once per chat. The move is journaled like
+        set_user_cfg, so a crash before the next snapshot doesn't lose it. The legacy hash dropped the sign, the
+        config goes to the first of the two chats that shows up.
+        """
+        if hashed_chat_id in cls._legacy_checked:
+            return
+        # hashed outside the lock, it can take a while for big chat ids
+        legacy_key = legacy_chat_id_digest(chat_id)
+        with cls._lock:
+            cls._legacy_checked.add(hashed_chat_id)
+            if legacy_key is None or legacy_key not in cls._legacy_keys:
+                return
+            cls._legacy_keys.discard(legacy_key)
+            user_cfg = cls._user_data.pop(legacy_key)
+            cls._seen_users.discard(legacy_key)
+            cls._seen_users.add(hashed_chat_id)
+            # a config journaled under the new key is newer than the legacy one
+            if hashed_chat_id not in cls._user_data:
+                append_lines(cls.journal_filepath(), [
+                    json.dumps({"chat_id": hashed_chat_id.hex(), "field": field, "value": value})
+                    for field, value in (("n", user_cfg.n), ("m", user_cfg.m))
+                ])
+                cls._user_data[hashed_chat_id] = user_cfg
+            cls._dirty = True
+            if not cls._legacy_keys:
+                cls._legacy_checked.clear()
+        logger.info(f"Migrated a legacy user config key, {len(cls._legacy_keys)} left.")
+
+    @classmethod
+    def lookup_user_cfg(cls, chat_id: bytes) -> UserConfig:
+        user_cfg = cls._user_data.get(chat_id)
+        if user_cfg is None:
+            if chat_id not in cls._seen_users:
+                cls._seen_users.add(chat_id)
+                cls._dirty = True
+            return UserConfig(cls.DEFAULT_N, cls.DEFAULT_M)
+        return user_cfg
 
     @classmethod
     @hash_chat_id
-    def get_user_cfg(cls, chat_id: str) -> UserConfig:
-        return cls._user_data[chat_id]
+    def get_user_cfg(cls, chat_id: bytes) -> UserConfig:
+        return cls.lookup_user_cfg(chat_id)
 
     @classmethod
     @hash_chat_id
-    def get_user_show_first_n(cls, chat_id: str) -> int:
-        return cls._user_data[chat_id].n
+    def get_user_show_first_n(cls, chat_id: bytes) -> int:
+        return cls.lookup_user_cfg(chat_id).n
 
     @classmethod
     @hash_chat_id
-    def get_user_show_min_threshold(cls, chat_id: str) -> int:
-        return cls._user_data[chat_id].m
+    def get_user_show_min_threshold(cls, chat_id: bytes) -> int:
+        return cls.lookup_user_cfg(chat_id).m
 
     @classmethod
     @hash_chat_id
-    def check_if_same_value(cls, chat_id: str, value: int, field: str) -> bool:
-        if field == "n" and cls._user_data[chat_id].n == value:
+    def check_if_same_value(cls, chat_id: bytes, value: int, field: str) -> bool:
+        if field == "n" and cls.lookup_user_cfg(chat_id).n == value:
             return True
-        elif field == "m" and cls._user_data[chat_id].m == value:
+        elif field == "m" and cls.lookup_user_cfg(chat_id).m == value:
             return True
         elif field not in {"n", "m"}:
             raise ValueError("Wrong config field, choose one between (n,m)")
@@ -240,70 +419,115 @@ class SearchConfigs:
 
     @classmethod
     @hash_chat_id
-    def set_user_cfg(cls, chat_id: str, value: int, field: str) -> None:
+    def set_user_cfg(cls, chat_id: bytes, value: int, field: str) -> None:
+        if field not in {"n", "m"}:
+            raise ValueError("User config field not valid.")
+        with cls._lock:
+            append_lines(
+                cls.journal_filepath(), [json.dumps({"chat_id": chat_id.hex(), "field": field, "value": value})]
+            )
+            cls.apply_user_cfg(chat_id, value, field)
+
+    @classmethod
+    def apply_user_cfg(cls, chat_id: bytes, value: int, field: str) -> None:
+        user_cfg = cls._user_data.get(chat_id)
+        if user_cfg is None:
+            user_cfg = cls._user_data[chat_id] = UserConfig(cls.DEFAULT_N, cls.DEFAULT_M)
+            cls._seen_users.add(chat_id)
         if field == "n":
-            cls._user_data[chat_id].n = value
-        elif field == "m":
-            cls._user_data[chat_id].m = value
+            user_cfg.n = value
         else:
-            raise ValueError("User config field not valid.")
+            user_cfg.m = value
+        cls._dirty = True
+
+    @classmethod
+    def get_users_total_n(cls) -> int:
+        """Chats seen before the seen users were first persisted are only counted if they changed their config."""
+        return len(cls._seen_users)
+
+    @classmethod
+    def journal_filepath(cls) -> str:
+        return os.path.join(cls.DUMP_FOLDER, cls.JOURNAL_FILENAME)
+
+    @classmethod
+    def list_compacting_journals(cls) -> List[str]:
+        return sorted(
+            os.path.join(cls.DUMP_FOLDER, filename)
+            for filename in os.listdir(cls.DUMP_FOLDER)
+            if filename.startswith(cls.JOURNAL_FILENAME) and filename.endswith(".compacting")
+        )
 
     @classmethod
     def normalize_user_data(cls) -> Dict:
         data = dict()
         for chat_id, user_cfg in cls._user_data.items():
-            data[chat_id] = {"n": user_cfg.n, "m": user_cfg.m}
+            data[chat_id.hex()] = {"n": user_cfg.n, "m": user_cfg.m}
 
         return data
 
     @classmethod
     def dump_data(cls, *args) -> int:
-        cls.clean_folder()
-        filename_backup = f"backup{datetime.strftime(datetime.now(), cls.DATE_FORMAT)}.json"
-        filepath = cls.USERS_CFG_FILEPATH
-        filepath_backup = os.path.join(cls.DUMP_FOLDER, filename_backup)
-        logger.info(f"I'm doing a dump for usr cfg data, backup {filename_backup}.")
         try:
-            with open(filepath_backup, "w") as f:
-                json.dump(cls.normalize_user_data(), f)
-            with open(filepath, "w") as f:
-                json.dump(cls.normalize_user_data(), f)
+            cls.snapshot_for_dump(True)()
             return 1
         except Exception as e:
             logger.error(f"Something wrong in dumping data Search Configs: {e}")
             traceback.print_exc()
             return 0
 
+    @classmethod
+    def snapshot_for_dump(cls, force: bool = False) -> Optional[Callable[[], int]]:
+        """Copy the configs and set the journal aside, the returned function writes the snapshot and drops the
+        journal entries it covers.
+
+        Only the copy happens under the lock, so set_user_cfg never waits for the writes."""
+        timestamp = datetime.strftime(datetime.now(), cls.DATE_FORMAT)
+        with cls._lock:
+            if not cls._dirty and not force:
+                return None
+            data = cls.normalize_user_data()
+            data[cls.SEEN_USERS_KEY] = [chat_id.hex() for chat_id in cls._seen_users if chat_id not in cls._user_data]
+            if os.path.exists(cls.journal_filepath()):
+                os.replace(cls.journal_filepath(), f"{cls.journal_filepath()}.{timestamp}.compacting")
+            compacting_journals = cls.list_compacting_journals()
+            cls._dirty = False
+
+        def write() -> int:
+            cls.clean_folder()
+            filename_backup = f"backup{timestamp}.json"
+            logger.info(f"I'm doing a dump for usr cfg data, backup {filename_backup}.")
+            try:
+                text = json.dumps(data)
+                n_bytes = atomic_write_text(os.path.join(cls.DUMP_FOLDER, filename_backup), text)
+                n_bytes += atomic_write_text(cls.USERS_CFG_FILEPATH, text)
+            except Exception:
+                # the set aside journals are still there, the next snapshot picks them up
+                cls._dirty = True
+                raise
+            for compacting_journal in compacting_journals:
+                os.remove(compacting_journal)
+            return n_bytes
+
+        return write
+
     @classmethod
     def list_backup_files(cls):
         for filename in os.listdir(cls.DUMP_FOLDER):
-            if filename.startswith('backup'):
+            if filename.startswith('backup') and filename.endswith('.json'):
                 yield filename
 
     @classmethod
     def clean_folder(cls) -> None:
         logger.info("Removing usr cfg older than 3 days...")
-        to_delete = set()
+        # the timestamp format sorts like the dates it encodes, no need to parse every name
+        oldest_kept = f"backup{datetime.strftime(datetime.now() - timedelta(days=3), cls.DATE_FORMAT)}"
         for filename in cls.list_backup_files():
-            year = int(filename[6:10])
-            month = int(filename[10:12])
-            day = int(filename[12:14])
-            hour = int(filename[15:17])
-            minute = int(filename[17:19])
-            second = int(filename[19:21])
-
-            timestamp = datetime(year, month, day, hour, minute, second)
-
-            if (datetime.now() - timestamp).days >= 3:
-                to_delete.add(os.path.join(cls.DUMP_FOLDER, filename))
-
-        for file_to_delete in to_delete:
-            os.remove(file_to_delete)
-    
+            if filename[:-len('.json')] <= oldest_kept:
+                os.remove(os.path.join(cls.DUMP_FOLDER, filename))
 
     @classmethod
     def get_newest_backup(cls):
-        files = os.listdir(cls.DUMP_FOLDER)
+        files = [filename for filename in os.listdir(cls.DUMP_FOLDER) if filename.endswith('.json')]
         paths = [os.path.join(cls.DUMP_FOLDER, basename) for basename in files]
         return max(paths, key=os.path.getctime)
 
@@ -316,25 +540,52 @@ class SearchConfigs:
             ) as f:
                 data = json.load(f)
 
-                for chat_id, payload in data.items():
-                    cls._user_data[chat_id] = UserConfig(int(payload["n"]), int(payload["m"]))
+                cls._seen_users.update(bytes.fromhex(chat_id_hex) for chat_id_hex in data.pop(cls.SEEN_USERS_KEY, []))
+                for chat_id_hex, payload in data.items():
+                    chat_id = bytes.fromhex(chat_id_hex)
+                    n, m = int(payload["n"]), int(payload["m"])
+                    # older dumps stored every chat that ever searched, the ones with the defaults are only counted
+                    if (n, m) == (cls.DEFAULT_N, cls.DEFAULT_M):
+                        cls._seen_users.add(chat_id)
+                        continue
+                    cls._user_data[chat_id] = UserConfig(n, m)
+                    cls._seen_users.add(chat_id)
 
         except Exception as e:
             logger.error(e)
             traceback.print_exc()
 
+        # changes made after the snapshot, oldest first
+        try:
+            n_replayed = 0
+            for journal in cls.list_compacting_journals() + [cls.journal_filepath()]:
+                for entry in read_json_lines(journal):
+                    cls.apply_user_cfg(bytes.fromhex(entry["chat_id"]), int(entry["value"]), entry["field"])
+                    n_replayed += 1
+            logger.info(f"Replayed {n_replayed} user config changes from the journal.")
+        except Exception as e:
+            logger.error(e)
+            traceback.print_exc()
+
+        cls._legacy_keys = {chat_id for chat_id in cls._user_data if len(chat_id) == cls.LEGACY_KEY_LENGTH}
+        cls._legacy_checked.clear()
+        if cls._legacy_keys:
+            logger.info(f"{len(cls._legacy_keys)} user configs still under a legacy key.")
+
     @classmethod
     def reset_user_data(cls) -> None:
         cls._user_data.clear()
+        cls._dirty = False
+        cls._seen_users.clear()
+        cls._legacy_keys.clear()
+        cls._legacy_checked.clear()
 
 class Utils:
 
     @classmethod
     def normalize_string(cls, s: str, remove_whitespace: Optional[bool]= False) -> str:
-        s = unidecode(s.lower())
-        s = re.sub("[^A-Za-z0-9 ]+", " ", s)
-        s = re.sub("[ ]+", " ", s).strip()
+        s = normalize_text(s, remove_stop_words=False)
         if remove_whitespace:
-            s = re.sub(" ", "", s).strip()
+            s = s.replace(" ", "")
 
         return s
@@ -1,10 +1,12 @@
-from typing import Dict, List
-from support.configuration import CACHE_FILEPATH
+from typing import Dict, List, Optional
+from support.configuration import CACHE_FILEPATH, CACHE_FORMAT, CACHE_DB_FILEPATH, CACHE_JOURNAL_COMPACT_EVERY
+from support.fileio import atomic_write_text, append_lines, read_json_lines
 from model.models import Episode
 import traceback
 import json
 import logging
 import os
+import sqlite3
 from functools import wraps
 
 logger = logging.getLogger("support.Cacher")
@@ -12,49 +14,194 @@ logger = logging.getLogger("support.Cacher")
 class Cacher:
 
     CACHE_FILEPATH = CACHE_FILEPATH
+    CACHE_DB_FILEPATH = CACHE_DB_FILEPATH
+    CACHE_FORMAT = CACHE_FORMAT
+    # bump it whenever the episodes table or what gets parsed into it changes, older files are rebuilt
+    CACHE_DB_VERSION = 1
+    CACHE_JOURNAL_COMPACT_EVERY = CACHE_JOURNAL_COMPACT_EVERY
+    # entries in the journal of CACHE_FILEPATH, read from disk only the first time it is needed
+    _journal_entries: Optional[int] = None
 
     @classmethod
     def set_cache_folder(cls, new_folder):
+        if os.path.isdir(new_folder):
+            new_folder = os.path.join(new_folder, "cache.json")
         cls.CACHE_FILEPATH = new_folder
+        cls.CACHE_DB_FILEPATH = os.path.splitext(new_folder)[0] + ".sqlite3"
+        cls._journal_entries = None
 
     @classmethod
     def cache_decorator(cls, func):
         @wraps(func)
         def wrapper_cache_decorator(*args, **kwargs):
+            if cls.CACHE_FORMAT == "sqlite":
+                return cls.load_or_collect_db(func, *args, **kwargs)
+
             try:
-                with open(cls.CACHE_FILEPATH, "r") as cachefile:
-                    cache = json.load(cachefile)
-                cache = {cache_ep_data["episode_id"]:Episode.from_dict(cache_ep_data) for cache_ep_data in cache}
+                cache = cls.load_json()
                 logger.info("Cache HIT")
             except (IOError, ValueError):
                 logger.info("Cache MISS")
                 traceback.print_exc()
                 cache = func(*args, **kwargs)
 
-            if not os.path.exists(cls.CACHE_FILEPATH):
-                with open(cls.CACHE_FILEPATH, "w") as cachefile:
-                    json.dump(cls.marshal_episodes_list(cache), cachefile)
+            if not os.path.exists(cls.CACHE_FILEPATH) or os.path.exists(cls.journal_filepath()):
+                cls.export_json(cache)
 
             return cache
 
         return wrapper_cache_decorator
 
+    @classmethod
+    def load_or_collect_db(cls, func, *args, **kwargs) -> Dict[str, Episode]:
+        try:
+            cache = cls.load_db()
+            logger.info("Cache HIT")
+            return cache
+        except (IOError, ValueError, sqlite3.Error):
+            logger.info("Cache db not available, looking for a JSON cache to import.")
+
+        try:
+            cache = cls.load_json()
+            logger.info("Cache HIT from JSON, importing it into the cache db")
+        except (IOError, ValueError):
+            logger.info("Cache MISS")
+            traceback.print_exc()
+            cache = func(*args, **kwargs)
+
+        cls.store_db(cache)
+        return cache
+
     @classmethod
     def marshal_episodes_list(cls, episodes: Dict[str, Episode]) -> List[Dict]:
         return [episode.to_dict() for episode in episodes.values()]
 
+    @classmethod
+    def journal_filepath(cls, filepath: str = None) -> str:
+        return f"{filepath or cls.CACHE_FILEPATH}.journal"
 
     @classmethod
-    def cache_updater(cls, new_episodes: Dict[str, Episode]) -> None:
+    def read_journal(cls, filepath: str = None) -> List[Dict]:
+        return read_json_lines(cls.journal_filepath(filepath))
+
+    @classmethod
+    def load_json(cls, filepath: str = None) -> Dict[str, Episode]:
+        with open(filepath or cls.CACHE_FILEPATH, "r") as cachefile:
+            cache = json.load(cachefile)
+        journal = cls.read_journal(filepath)
+        if filepath is None:
+            cls._journal_entries = len(journal)
+        cache.extend(journal)
+        return {cache_ep_data["episode_id"]: Episode.from_dict(cache_ep_data) for cache_ep_data in cache}
 
+    @classmethod
+    def export_json(cls, episodes: Dict[str, Episode], filepath: str = None) -> None:
+        atomic_write_text(filepath or cls.CACHE_FILEPATH, json.dumps(cls.marshal_episodes_list(episodes)))
+        # the journal is folded in the file just written, replaying it again would only find duplicates
+        if os.path.exists(cls.journal_filepath(filepath)):
+            os.remove(cls.journal_filepath(filepath))
+        if filepath is None:
+            cls._journal_entries = 0
+
+    @classmethod
+    def compact_journal(cls) -> None:
+        logger.info("Compacting cache journal into the cache file...")
+        cls.export_json(cls.load_json())
+
+    @classmethod
+    def import_json(cls, filepath: str = None) -> Dict[str, Episode]:
+        episodes = cls.load_json(filepath)
+        cls.store_db(episodes)
+        return episodes
+
+    @classmethod
+    def connect_db(cls) -> sqlite3.Connection:
+        connection = sqlite3.connect(cls.CACHE_DB_FILEPATH)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS episodes (
+                    position INTEGER PRIMARY KEY AUTOINCREMENT,
+                    episode_id TEXT UNIQUE NOT NULL,
+                    title TEXT NOT NULL,
+                    published_at TEXT NOT NULL,
+                    site_url TEXT NOT NULL,
+                    description_raw TEXT NOT NULL,
+                    number INTEGER NOT NULL,
+                    sub_number TEXT NOT NULL,
+                    title_str TEXT NOT NULL,
+                    hosts TEXT NOT NULL,
+                    topics TEXT NOT NULL
+                )
+            """)
+            connection.execute(f"PRAGMA user_version = {cls.CACHE_DB_VERSION}")
+            connection.commit()
+        elif version != cls.CACHE_DB_VERSION:
+            connection.close()
+            raise ValueError(f"Cache db version {version} is not {cls.CACHE_DB_VERSION}")
+        return connection
+
+    @classmethod
+    def load_db(cls) -> Dict[str, Episode]:
+        if not os.path.exists(cls.CACHE_DB_FILEPATH):
+            raise FileNotFoundError(cls.CACHE_DB_FILEPATH)
+
+        connection = cls.connect_db()
+        try:
+            cursor = connection.execute("""
+                SELECT episode_id, title, published_at, site_url, description_raw,
+                    number, sub_number, title_str, hosts, topics
+                FROM episodes ORDER BY position
+            """)
+            # each row becomes an episode as the cursor reads it, the whole result set is never held at once
+            episodes = {row[0]: Episode.from_record(row) for row in cursor}
+        finally:
+            connection.close()
+
+        if not episodes:
+            raise ValueError("Cache db is empty")
+
+        return episodes
+
+    @classmethod
+    def store_db(cls, episodes: Dict[str, Episode]) -> None:
+        connection = cls.connect_db()
         try:
-            with open(cls.CACHE_FILEPATH, "r") as cachefile:
-                data = json.load(cachefile)
-            for ep in cls.marshal_episodes_list(new_episodes):
-                data.append(ep)
-            with open(cls.CACHE_FILEPATH, "w") as cachefile:
-                json.dump(data, cachefile)
+            with connection:
+                connection.executemany("""
+                    INSERT OR IGNORE INTO episodes (
+                        episode_id, title, published_at, site_url, description_raw,
+                        number, sub_number, title_str, hosts, topics
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [episode.to_record() for episode in episodes.values()])
+        finally:
+            connection.close()
+
+    @classmethod
+    def cache_updater(cls, new_episodes: Dict[str, Episode]) -> None:
+
+        if cls.CACHE_FORMAT == "sqlite":
+            try:
+                cls.store_db(new_episodes)
                 logger.info("Cache updated properly")
+            except (sqlite3.Error, ValueError):
+                logger.error("Cache update failed.")
+                traceback.print_exc()
+            return
+
+        try:
+            if not os.path.exists(cls.CACHE_FILEPATH):
+                raise FileNotFoundError(cls.CACHE_FILEPATH)
+            if cls._journal_entries is None:
+                cls._journal_entries = len(cls.read_journal())
+            append_lines(
+                cls.journal_filepath(),
+                [json.dumps(ep) for ep in cls.marshal_episodes_list(new_episodes)]
+            )
+            cls._journal_entries += len(new_episodes)
+            logger.info("Cache updated properly")
+            if cls._journal_entries >= cls.CACHE_JOURNAL_COMPACT_EVERY:
+                cls.compact_journal()
         except (IOError, ValueError):
             logger.error("Cache update failed.")
             traceback.print_exc()
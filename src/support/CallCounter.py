@@ -1,48 +1,188 @@
-from support.configuration import CALL_COUNTER_FILEPATH
+from support.configuration import CALL_COUNTER_FILEPATH, LEGACY_CALL_COUNTER_FILEPATH
+from support.fileio import append_lines, atomic_write_text
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import Counter
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
 import json
+import os
 from time import time
 import traceback
 import logging
 
 logger = logging.getLogger('support.CallCounter')
 
+SECONDS_IN_AN_HOUR = 3600
+SECONDS_IN_A_DAY = 24 * SECONDS_IN_AN_HOUR
+
+class TimeSeries:
+    """Counts in sorted buckets, with running totals so the sum over a range is two bisects and a subtraction."""
+
+    def __init__(self) -> None:
+        self.timestamps = array('q')
+        self.counts = array('q')
+        # cumulative[i] = sum(counts[:i + 1])
+        self.cumulative = array('q')
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def add(self, timestamp: int, count: int = 1) -> None:
+        if self.timestamps and timestamp == self.timestamps[-1]:
+            self.counts[-1] += count
+            self.cumulative[-1] += count
+        elif not self.timestamps or timestamp > self.timestamps[-1]:
+            self.timestamps.append(timestamp)
+            self.counts.append(count)
+            self.cumulative.append((self.cumulative[-1] if self.cumulative else 0) + count)
+        else:
+            # late write (clock going back, loading an unsorted file), the running totals after it shift
+            pos = bisect_left(self.timestamps, timestamp)
+            if self.timestamps[pos] != timestamp:
+                self.timestamps.insert(pos, timestamp)
+                self.counts.insert(pos, 0)
+                self.cumulative.insert(pos, self.cumulative[pos - 1] if pos > 0 else 0)
+            self.counts[pos] += count
+            for i in range(pos, len(self.cumulative)):
+                self.cumulative[i] += count
+
+    def total_until(self, pos: int) -> int:
+        """Sum of the first pos buckets."""
+        return self.cumulative[pos - 1] if pos > 0 else 0
+
+    def sum_between(self, from_: int, to: int) -> int:
+        """Sum of the buckets with from_ <= timestamp <= to."""
+        return self.total_until(bisect_right(self.timestamps, to)) - self.total_until(bisect_left(self.timestamps, from_))
+
+    def items(self) -> List[Tuple[int, int]]:
+        return list(zip(self.timestamps, self.counts))
+
+
 class CallCounter():
 
     instance = None
     CALL_COUNTER_FILEPATH = CALL_COUNTER_FILEPATH
-    
+    LEGACY_CALL_COUNTER_FILEPATH = LEGACY_CALL_COUNTER_FILEPATH
+
     @classmethod
     def set_call_counter_filepath(cls, new_path):
         cls.CALL_COUNTER_FILEPATH = new_path
-    
+
     def __new__(cls,*args, **kwargs):
         if cls.instance:
             return cls.instance
         else:
             cls.instance = super().__new__(cls,*args, **kwargs)
-            return cls.instance        
+            return cls.instance
 
     def __init__(self) -> None:
+        self.lock = Lock()
+        self.hours = TimeSeries()
+        # rolled up on write, so whole days are never summed hour by hour
+        self.days = TimeSeries()
+        # calls not on disk yet, by hour
+        self.unflushed: Counter = Counter()
+        self.load()
+
+    @classmethod
+    def migrate_legacy_file(cls) -> None:
+        """Convert the old JSON store into the log, once: the JSON is renamed afterwards so nothing reads it stale."""
+        if os.path.exists(cls.CALL_COUNTER_FILEPATH) or not os.path.exists(cls.LEGACY_CALL_COUNTER_FILEPATH):
+            return
+        logger.info(f"Converting the call counter JSON {cls.LEGACY_CALL_COUNTER_FILEPATH} to the log.")
+        with open(cls.LEGACY_CALL_COUNTER_FILEPATH, "r") as f:
+            legacy: Dict[str, int] = json.load(f)
+        hours = sorted((int(hour), count) for hour, count in legacy.items())
+        atomic_write_text(cls.CALL_COUNTER_FILEPATH, "".join(f"{hour} {count}\n" for hour, count in hours))
+        os.replace(cls.LEGACY_CALL_COUNTER_FILEPATH, f"{cls.LEGACY_CALL_COUNTER_FILEPATH}.migrated")
+
+    def load(self) -> None:
+        """Read the "hour count" lines of the log."""
+        CallCounter.migrate_legacy_file()
+        if not os.path.exists(CallCounter.CALL_COUNTER_FILEPATH):
+            return
         with open(CallCounter.CALL_COUNTER_FILEPATH, "r") as f:
-            data = json.load(f)
-            counter: Counter = Counter(data)
-        self.counter: Counter = counter
+            lines = f.read().splitlines()
+
+        n_lines = 0
+        for line in lines:
+            try:
+                hour, count = line.split()
+                self.add_calls(int(hour), int(count))
+                n_lines += 1
+            except ValueError:
+                # an append cut short by a crash
+                if line.strip():
+                    logger.error("Call counter log has a truncated line, skipping it.")
+
+        # every dump appends the open hour again, squash the log once it is mostly repeated hours
+        if n_lines > 2 * len(self.hours):
+            atomic_write_text(
+                CallCounter.CALL_COUNTER_FILEPATH, "".join(f"{hour} {count}\n" for hour, count in self.hours.items())
+            )
+
+    def add_calls(self, hour_timestamp: int, count: int) -> None:
+        self.hours.add(hour_timestamp, count)
+        self.days.add(hour_timestamp // SECONDS_IN_A_DAY * SECONDS_IN_A_DAY, count)
 
     def add_call(self) -> None:
         minute_timestamp: int = int(time()) // 3600 * 3600
 
-        self.counter[str(minute_timestamp)] += 1
+        with self.lock:
+            self.add_calls(minute_timestamp, 1)
+            self.unflushed[minute_timestamp] += 1
+
+    def count_between(self, from_: int, to: int) -> int:
+        with self.lock:
+            return self.hours.sum_between(from_, to)
+
+    def daily_counts(self, from_: int, to: int) -> List[Tuple[int, int]]:
+        """(day, calls) for the days with calls made between from_ and to, in order."""
+        daily = list()
+        with self.lock:
+            first_day = from_ // SECONDS_IN_A_DAY * SECONDS_IN_A_DAY
+            start = bisect_left(self.days.timestamps, first_day)
+            end = bisect_right(self.days.timestamps, to)
+            for pos in range(start, end):
+                day = self.days.timestamps[pos]
+                if day >= from_ and day + SECONDS_IN_A_DAY - 1 <= to:
+                    count = self.days.counts[pos]
+                else:
+                    # only part of the day is in range
+                    count = self.hours.sum_between(max(day, from_), min(day + SECONDS_IN_A_DAY - 1, to))
+                if count:
+                    daily.append((day, count))
+        return daily
+
+    def snapshot_for_dump(self, force: bool = False) -> Optional[Callable[[], int]]:
+        """Take the calls not on disk yet, the returned function appends them to the log."""
+        with self.lock:
+            if not self.unflushed:
+                return None
+            unflushed = sorted(self.unflushed.items())
+            self.unflushed = Counter()
+
+        def write() -> int:
+            logger.info("Saving call counter cache...")
+            try:
+                return append_lines(CallCounter.CALL_COUNTER_FILEPATH, [f"{hour} {count}" for hour, count in unflushed])
+            except Exception:
+                with self.lock:
+                    self.unflushed.update(dict(unflushed))
+                raise
+
+        return write
 
     def dump_data(self, *args) -> int:
         try:
-            logger.info("Saving call counter cache...")
-            with open(CallCounter.CALL_COUNTER_FILEPATH, "w") as f:
-                json.dump(self.counter, f)
-                logger.info("Saved call counter successfully")
-                return 1
+            write = self.snapshot_for_dump(True)
+            if write is not None:
+                write()
+            logger.info("Saved call counter successfully")
+            return 1
         except Exception as e:
             logger.info("Something went wrong saving call counter")
             logger.error(e)
             traceback.print_exc()
-            return 0
\ No newline at end of file
+            return 0
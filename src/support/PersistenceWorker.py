@@ -0,0 +1,105 @@
+from threading import Condition, Lock, Thread
+from typing import Callable, Dict, Optional
+import logging
+import time
+import traceback
+
+logger = logging.getLogger("support.PersistenceWorker")
+
+# called with force, returns None if there is nothing new to write, otherwise a function doing the write
+# (serialization and I/O, off any lock) that returns the bytes written
+SnapshotFunc = Callable[[bool], Optional[Callable[[], int]]]
+
+class PersistenceWorker:
+    """Single thread writing what the stores snapshot, requests for a store already waiting are coalesced."""
+
+    def __init__(self) -> None:
+        self.stores: Dict[str, SnapshotFunc] = dict()
+        # store name -> forced, in request order
+        self.pending: Dict[str, bool] = dict()
+        self.condition = Condition()
+        # a store is never written by the worker and a flush at the same time
+        self.dump_lock = Lock()
+        self.stats_lock = Lock()
+        self.dump_stats: Dict[str, Dict[str, float]] = dict()
+        self.running = False
+        self.thread: Optional[Thread] = None
+
+    def register(self, name: str, snapshot: SnapshotFunc) -> None:
+        self.stores[name] = snapshot
+        self.dump_stats[name] = {
+            "dumps": 0, "skipped": 0, "errors": 0, "last_seconds": 0.0, "last_bytes": 0, "total_bytes": 0
+        }
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = Thread(target=self.run, name="persistence", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the worker, writing in the calling thread the requests it didn't get to."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        with self.condition:
+            pending = self.pending
+            self.pending = dict()
+        for name, force in pending.items():
+            self.dump(name, force)
+
+    def request(self, name: str, *args, force: bool = False) -> None:
+        """Ask for a dump of name, returns at once. Usable as a job queue callback."""
+        with self.condition:
+            self.pending[name] = self.pending.get(name, False) or force
+            self.condition.notify()
+
+    def flush(self) -> Dict[str, int]:
+        """Write every store now, in the calling thread, returns 1 or 0 per store like the old dumps."""
+        with self.condition:
+            for name in self.stores:
+                self.pending.pop(name, None)
+        return {name: self.dump(name, force=True) for name in self.stores}
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                pending = self.pending
+                self.pending = dict()
+            for name, force in pending.items():
+                self.dump(name, force)
+
+    def dump(self, name: str, force: bool = False) -> int:
+        with self.dump_lock:
+            start = time.perf_counter()
+            try:
+                write = self.stores[name](force)
+                if write is None:
+                    with self.stats_lock:
+                        self.dump_stats[name]["skipped"] += 1
+                    return 1
+                n_bytes = write()
+            except Exception as e:
+                logger.error(f"Dump of {name} failed: {e}")
+                traceback.print_exc()
+                with self.stats_lock:
+                    self.dump_stats[name]["errors"] += 1
+                return 0
+            elapsed = time.perf_counter() - start
+            with self.stats_lock:
+                stats = self.dump_stats[name]
+                stats["dumps"] += 1
+                stats["last_seconds"] = elapsed
+                stats["last_bytes"] = n_bytes
+                stats["total_bytes"] += n_bytes
+            logger.info(f"Dumped {name}: {n_bytes} bytes in {elapsed:.3f}s")
+            return 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self.stats_lock:
+            return {name: dict(stats) for name, stats in self.dump_stats.items()}
@@ -0,0 +1,112 @@
+from collections import Counter
+from typing import Dict, Hashable, List, Optional, Tuple
+import heapq
+
+
+class SpaceSavingCounter:
+    """Space-Saving heavy hitters sketch, keeps at most capacity items.
+
+    Every kept count overestimates the true one by at most its error, which is never more than total / capacity,
+    and any item whose true count is above total / capacity is guaranteed to be kept. Items sit in buckets by
+    count, so an increment moves one item between two buckets and the eviction victim is found in O(1).
+    """
+
+    def __init__(self, capacity: int) -> None:
+        if capacity < 1:
+            raise ValueError("SpaceSavingCounter capacity must be positive")
+        self.capacity = capacity
+        self.total = 0
+        self.counts: Dict[Hashable, int] = dict()
+        self.errors: Dict[Hashable, int] = dict()
+        # count -> items with that count, dicts keep insertion order so the oldest is evicted first
+        self.buckets: Dict[int, Dict[Hashable, None]] = dict()
+        self.min_count = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __getitem__(self, item: Hashable) -> int:
+        return self.counts.get(item, 0)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.counts
+
+    def error_bound(self) -> float:
+        return self.total / self.capacity
+
+    def _move(self, item: Hashable, old_count: int, new_count: int) -> None:
+        bucket = self.buckets[old_count]
+        del bucket[item]
+        if not bucket:
+            del self.buckets[old_count]
+        self.buckets.setdefault(new_count, dict())[item] = None
+
+    def _fix_min_count(self, emptied_count: int, new_count: int) -> None:
+        if emptied_count == self.min_count and emptied_count not in self.buckets:
+            # a single increment lands in the next bucket, bigger jumps only happen when loading
+            self.min_count = new_count if new_count == emptied_count + 1 else min(self.buckets)
+
+    def add(self, item: Hashable, count: int = 1) -> None:
+        self.total += count
+        old_count = self.counts.get(item)
+        if old_count is not None:
+            new_count = old_count + count
+            self.counts[item] = new_count
+            self._move(item, old_count, new_count)
+            self._fix_min_count(old_count, new_count)
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+            self.buckets.setdefault(count, dict())[item] = None
+            self.min_count = count if len(self.counts) == 1 else min(self.min_count, count)
+        else:
+            # take over the slot of an item with the smallest count, inheriting it as error
+            min_count = self.min_count
+            min_bucket = self.buckets[min_count]
+            victim = next(iter(min_bucket))
+            del min_bucket[victim]
+            if not min_bucket:
+                del self.buckets[min_count]
+            del self.counts[victim]
+            del self.errors[victim]
+            new_count = min_count + count
+            self.counts[item] = new_count
+            self.errors[item] = min_count
+            self.buckets.setdefault(new_count, dict())[item] = None
+            self._fix_min_count(min_count, new_count)
+
+    def most_common(self, n: int = None) -> List[Tuple[Hashable, int]]:
+        if n is None:
+            return sorted(self.counts.items(), key=lambda item_count: item_count[1], reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=lambda item_count: item_count[1])
+
+    def to_dict(self) -> Dict:
+        return {
+            "capacity": self.capacity,
+            "total": self.total,
+            "items": [[item, count, self.errors[item]] for item, count in self.counts.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict, capacity: Optional[int] = None) -> "SpaceSavingCounter":
+        """Restore a sketch, with capacity instead of the saved one if given. Shrinking keeps the highest counts."""
+        sketch = cls(capacity or data["capacity"])
+        items = data["items"]
+        if len(items) > sketch.capacity:
+            # in their saved order, which decides the eviction order among equal counts
+            top = heapq.nlargest(sketch.capacity, range(len(items)), key=lambda i: items[i][1])
+            items = [items[i] for i in sorted(top)]
+        for item, count, error in items:
+            sketch.add(item, count)
+            sketch.errors[item] = error
+        sketch.total = data["total"]
+        return sketch
+
+    @classmethod
+    def from_counter(cls, counter: Counter, capacity: int) -> "SpaceSavingCounter":
+        """Keep the capacity most common items exactly, the tail is dropped but still counted in total."""
+        sketch = cls(capacity)
+        for item, count in counter.most_common(capacity):
+            sketch.add(item, count)
+        sketch.total = sum(counter.values())
+        return sketch
@@ -1,6 +1,7 @@
 class TextRepo:
 
     MSG_NO_RES = "Spiacente! Nessun match rilevato."
+    MSG_EPISODES_LOADING = "Sto ancora caricando gli episodi, riprova tra qualche istante."
 
     MSG_RESPONSE = """
 ---------------- MATCH #{} --{}--------------
@@ -50,12 +51,18 @@ oppure qualsiasi altro argomento ti venga in mente.
 
     MSG_DAILY_REPORT = "Log giornaliero dal {} al {} (UTC)"
 
+    MSG_QUERY_CACHE_STATS = "Cache ricerche: {size}/{maxsize} voci\nHit: {hits}\nMiss: {misses}\nEviction: {evictions}"
+    MSG_PERSISTENCE_STATS = "{name}: {dumps} dump, {skipped} saltati, {errors} errori\n" \
+                            "ultimo {last_bytes} byte in {last_seconds:.3f}s, totale {total_bytes} byte"
+
     MSG_MEMO_AMDIN = """
 `/dump`\ndumpa tutto\n
 `/nu`\nutenti totali\n
 `/neps`\ntotale episodi\n
 `/ncw $n`\nparole più cercate\n
 `/qry $from [$to]`\nlog giornalieri da DDMMYY a oggi, oppure a DDMMYY\n
+`/qcache`\nstatistiche cache ricerche\n
+`/pstats`\nstatistiche salvataggi\n
 """
 
     MSG_SINGLE_TOPIC = '<a href="{}">{}</a>'
\ No newline at end of file
@@ -1,7 +1,13 @@
 from support.configuration import SRC_FOLDER, config, WORD_COUNTER_FILEPATH
+from support.configuration import WORD_COUNTER_MODE, WORD_COUNTER_CAPACITY
+from support.SpaceSavingCounter import SpaceSavingCounter
+from support.fileio import atomic_write_text
 import os
 import json
 from collections import Counter
+from typing import Callable, List, Optional, Tuple
+from threading import Lock
+import traceback
 import logging
 
 logger = logging.getLogger('support.WordCounter')
@@ -9,6 +15,8 @@ logger = logging.getLogger('support.WordCounter')
 class WordCounter:
     instance = None
     WORD_COUNTER_FILEPATH = WORD_COUNTER_FILEPATH
+    # key of the persisted sketch, normalized queries never contain underscores
+    SKETCH_KEY = "__space_saving__"
     
     @classmethod
     def set_word_counter_filepath(cls, new_path):
@@ -18,25 +26,67 @@ class WordCounter:
         if cls.instance:
             return cls.instance
         else:
-            cls.instance = super().__new__(cls,*args, **kwargs)
+            cls.instance = super().__new__(cls)
             return cls.instance        
 
-    def __init__(self) -> None:
+    def __init__(self, mode: str = WORD_COUNTER_MODE, capacity: int = WORD_COUNTER_CAPACITY) -> None:
         with open(WordCounter.WORD_COUNTER_FILEPATH, "r") as f:
             data = json.load(f)
-            counter: Counter = Counter(data)
-        self.counter: Counter = counter
+        self.mode = mode
+        self.lock = Lock()
+        self.dirty = False
+        if mode == "space_saving":
+            if WordCounter.SKETCH_KEY in data:
+                self.counter = SpaceSavingCounter.from_dict(data[WordCounter.SKETCH_KEY], capacity)
+            else:
+                logger.info(f"Reducing the exact word counter to its {capacity} most common queries.")
+                self.counter = SpaceSavingCounter.from_counter(Counter(data), capacity)
+        elif mode == "exact":
+            if WordCounter.SKETCH_KEY in data:
+                logger.warning("Word counter file holds a sketch, its counts are approximate.")
+                data = {item: count for item, count, error in data[WordCounter.SKETCH_KEY]["items"]}
+            self.counter = Counter(data)
+        else:
+            raise ValueError(f"Unknown word counter mode {mode}")
 
     def add_word(self, word):
-        self.counter[word] += 1
+        with self.lock:
+            if self.mode == "space_saving":
+                self.counter.add(word)
+            else:
+                self.counter[word] += 1
+            self.dirty = True
 
-    def dump_counter(self):
-        try:
+    def most_common(self, n: int) -> List[Tuple[str, int]]:
+        with self.lock:
+            return self.counter.most_common(n)
+
+    def snapshot_for_dump(self, force: bool = False) -> Optional[Callable[[], int]]:
+        """Copy the counts under the lock, the returned function serializes and writes them."""
+        with self.lock:
+            if not self.dirty and not force:
+                return None
+            if self.mode == "space_saving":
+                data = {WordCounter.SKETCH_KEY: self.counter.to_dict()}
+            else:
+                data = dict(self.counter)
+            self.dirty = False
+
+        def write() -> int:
             logger.info("Saving word counter cache...")
-            with open(WordCounter.WORD_COUNTER_FILEPATH, "w") as f:
-                json.dump(self.counter, f)
-                logger.info("Saved word counter successfully")
-                return 1
+            try:
+                return atomic_write_text(WordCounter.WORD_COUNTER_FILEPATH, json.dumps(data))
+            except Exception:
+                self.dirty = True
+                raise
+
+        return write
+
+    def dump_counter(self, *args):
+        try:
+            self.snapshot_for_dump(True)()
+            logger.info("Saved word counter successfully")
+            return 1
         except Exception as e:
             logger.info("Something went wrong saving word counter")
             logger.error(e)
@@ -1,7 +1,19 @@
-from support.configuration import config
-from requests import get
+from support.configuration import config, API_MAX_IN_FLIGHT, API_MAX_RETRIES, API_BACKOFF_FACTOR
+from support.configuration import API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_VALIDATORS_FILEPATH
+from support.fileio import atomic_write_text
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from model.custom_exceptions import StatusCodeNot200
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import logging
+import json
+import os
+import time
+
+logger = logging.getLogger("support.apiclient")
 
 class SpreakerAPIClient:
     BASE_URL: str = config["URLS"].get("BASE_URL")
@@ -10,17 +22,99 @@ class SpreakerAPIClient:
     GET_SINGLE_EPISODE_URL: str = BASE_URL + config["URLS"].get("GET_SINGLE_EPISODE")
     GET_SHOW_URL: str = BASE_URL + config["URLS"].get("GET_SHOW")
 
-    def __init__(self, token: str) -> None:
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        token: str,
+        max_in_flight: int = API_MAX_IN_FLIGHT,
+        max_retries: int = API_MAX_RETRIES,
+        backoff_factor: float = API_BACKOFF_FACTOR,
+        validators_filepath: str = API_VALIDATORS_FILEPATH
+    ) -> None:
+        self.token = token
         self.headers = {"Authorization": f"Bearer {token}"}
+        self.max_in_flight = max_in_flight
+        self.timeout = (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=self.RETRY_STATUS_CODES,
+            allowed_methods={"GET"},
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=max_in_flight)
+        self.session = Session()
+        self.session.headers.update(self.headers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats_lock = Lock()
+        self.endpoint_stats: Dict[str, Dict[str, float]] = dict()
+        # ETag / Last-Modified per url, pending ones are persisted only once the caller commits them
+        self.validators_filepath = validators_filepath
+        self.validators: Dict[str, Dict[str, str]] = self.load_validators()
+        self.pending_validators: Dict[str, Dict[str, str]] = dict()
+
+    def get(self, endpoint: str, url: str, headers: Optional[Dict[str, str]] = None) -> Response:
+        """GET through the pooled session, recording latency and retries under endpoint."""
+        start = time.perf_counter()
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        elapsed = time.perf_counter() - start
+        retries = getattr(response.raw, "retries", None)
+        n_retries = len(retries.history) if retries is not None else 0
+        with self.stats_lock:
+            stats = self.endpoint_stats.setdefault(
+                endpoint, {"calls": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            )
+            stats["calls"] += 1
+            stats["retries"] += n_retries
+            stats["total_seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        return response
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self.stats_lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.endpoint_stats.items()}
+
+    def load_validators(self) -> Dict[str, Dict[str, str]]:
+        if not os.path.exists(self.validators_filepath):
+            return dict()
+        try:
+            with open(self.validators_filepath, "r") as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning(f"Ignoring unreadable validators file {self.validators_filepath}")
+            return dict()
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        validator = self.validators.get(url, dict())
+        headers = dict()
+        if "etag" in validator:
+            headers["If-None-Match"] = validator["etag"]
+        if "last_modified" in validator:
+            headers["If-Modified-Since"] = validator["last_modified"]
+        return headers
+
+    def commit_validators(self) -> None:
+        """Persist the validators of the responses the caller has finished processing."""
+        if not self.pending_validators:
+            return
+        self.validators.update(self.pending_validators)
+        self.pending_validators = dict()
+        atomic_write_text(self.validators_filepath, json.dumps(self.validators))
+
+    def close(self) -> None:
+        self.session.close()
 
     def get_show(self, show_id: str) -> Any:
-        result = get(SpreakerAPIClient.GET_SHOW_URL.format(show_id))
+        result = self.get("get_show", SpreakerAPIClient.GET_SHOW_URL.format(show_id))
         if result.status_code != 200:
             raise StatusCodeNot200("get_show result status != 200")
         return result.json()
 
     def get_user_shows(self, user_id: str) -> Dict:
-        result = get(SpreakerAPIClient.GET_USER_SHOWS_URL.format(user_id))
+        result = self.get("get_user_shows", SpreakerAPIClient.GET_USER_SHOWS_URL.format(user_id))
         if result.status_code != 200:
             raise StatusCodeNot200("get_user_shows result status != 200")
         return result.json()
@@ -33,7 +127,7 @@ class SpreakerAPIClient:
         n_loop = 0
         while not stop_loop:
             n_loop += 1
-            response = get(url)
+            response = self.get("get_show_episodes", url)
             if response.status_code != 200:
                 raise StatusCodeNot200(
                     f"get_show_episodes loop #{n_loop} result status != 200"
@@ -46,18 +140,33 @@ class SpreakerAPIClient:
                 url = res_json["response"]["next_url"]
         return episodes
 
-    def get_last_n_episode(self, show_id: str, n: int) -> List[Dict]:
+    def get_last_n_episode(self, show_id: str, n: int) -> Optional[List[Dict]]:
+        """Newest n episodes, or None when the feed hasn't changed since the last committed validator."""
         url = (
             SpreakerAPIClient.GET_SHOW_EPISODES_URL.format(show_id)
             + f"?limit={n}&sorting=newest"
         )
-        res = get(url)
+        res = self.get("get_last_n_episode", url, self.conditional_headers(url))
+        if res.status_code == 304:
+            return None
         if res.status_code != 200:
             raise StatusCodeNot200("get_last_n_episode result status != 200")
+        validator = dict()
+        if "ETag" in res.headers:
+            validator["etag"] = res.headers["ETag"]
+        if "Last-Modified" in res.headers:
+            validator["last_modified"] = res.headers["Last-Modified"]
+        if validator:
+            self.pending_validators[url] = validator
         return res.json()["response"]["items"]
 
     def get_episode_info(self, episode_id: str) -> Dict:
-        response = get(SpreakerAPIClient.GET_SINGLE_EPISODE_URL.format(episode_id))
+        response = self.get("get_episode_info", SpreakerAPIClient.GET_SINGLE_EPISODE_URL.format(episode_id))
         if response.status_code != 200:
-            raise StatusCodeNot200("")
+            raise StatusCodeNot200(f"get_episode_info for {episode_id} result status {response.status_code}")
         return response.json()
+
+    def get_episodes_info(self, episode_ids: List[str]) -> Dict[str, Dict]:
+        """get_episode_info for many episodes, with at most max_in_flight requests running at the same time."""
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            return dict(zip(episode_ids, executor.map(self.get_episode_info, episode_ids)))
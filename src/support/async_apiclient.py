@@ -0,0 +1,84 @@
+from support.configuration import API_MAX_IN_FLIGHT, API_MAX_RETRIES, API_BACKOFF_FACTOR
+from support.configuration import API_CONNECT_TIMEOUT, API_READ_TIMEOUT
+from support.apiclient import SpreakerAPIClient
+from model.custom_exceptions import StatusCodeNot200
+from typing import AsyncIterator, Dict, List, Optional
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger("support.async_apiclient")
+
+class AsyncSpreakerAPIClient:
+    """asyncio twin of SpreakerAPIClient for ingestion, meant to be used as an async context manager."""
+
+    def __init__(
+        self,
+        token: str,
+        max_in_flight: int = API_MAX_IN_FLIGHT,
+        max_retries: int = API_MAX_RETRIES,
+        backoff_factor: float = API_BACKOFF_FACTOR
+    ) -> None:
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.client: Optional[httpx.AsyncClient] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> "AsyncSpreakerAPIClient":
+        # created here so that they belong to the running loop
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=httpx.Timeout(API_READ_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+        )
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.client.aclose()
+
+    async def get(self, url: str) -> httpx.Response:
+        """
+        GET retrying rate limited (429) and 5xx responses, honouring Retry-After when the API sends it,
+        and connection errors and timeouts, raised again once the retries are over.
+        """
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await self.client.get(url)
+                except httpx.TransportError as e:
+                    # timeouts included
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff_factor * 2 ** attempt
+                    logger.info(f"{type(e).__name__} from {url}, retrying in {delay}s")
+                else:
+                    if response.status_code not in SpreakerAPIClient.RETRY_STATUS_CODES or attempt == self.max_retries:
+                        break
+                    retry_after = response.headers.get("Retry-After")
+                    delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff_factor * 2 ** attempt
+                    logger.info(f"Got {response.status_code} from {url}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+        return response
+
+    async def iter_show_episode_pages(self, show_id: str) -> AsyncIterator[List[Dict]]:
+        url = SpreakerAPIClient.GET_SHOW_EPISODES_URL.format(show_id) + "?limit=100"
+        n_loop = 0
+        while url is not None:
+            n_loop += 1
+            response = await self.get(url)
+            if response.status_code != 200:
+                raise StatusCodeNot200(
+                    f"iter_show_episode_pages loop #{n_loop} result status != 200"
+                )
+            res_json = response.json()
+            yield res_json["response"]["items"]
+            url = res_json["response"]["next_url"]
+
+    async def get_episode_info(self, episode_id: str) -> Dict:
+        response = await self.get(SpreakerAPIClient.GET_SINGLE_EPISODE_URL.format(episode_id))
+        if response.status_code != 200:
+            raise StatusCodeNot200(f"get_episode_info for {episode_id} result status {response.status_code}")
+        return response.json()
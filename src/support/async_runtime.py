@@ -0,0 +1,415 @@
+from support.configuration import TELEGRAM_API_URL, RUNTIME_WORKERS, RUNTIME_POLL_TIMEOUT
+from support.configuration import RUNTIME_MAX_CONCURRENT_UPDATES, RUNTIME_MAX_CONCURRENT_SENDS
+from support.configuration import RUNTIME_SEND_BURST_LIMIT, RUNTIME_SEND_TIME_LIMIT_MS
+from support.configuration import API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_MAX_RETRIES
+from support.configuration import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN
+from support.configuration import WEBHOOK_QUEUE_SIZE, WEBHOOK_BATCH_SIZE
+from model.custom_exceptions import StatusCodeNot200
+from telegram import Update
+from telegram.ext import Handler
+from telegram.utils.helpers import DefaultValue
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from threading import Event
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+import asyncio
+import hmac
+import json
+import logging
+import time
+import traceback
+import httpx
+
+logger = logging.getLogger("support.async_runtime")
+
+class AsyncTelegramBot:
+    """Bot API client on httpx with the methods the handlers use.
+
+    The handlers run in executor threads: send_message and send_chat_action hand the request to the event loop
+    and return at once, so a worker is never held by the network."""
+
+    def __init__(
+        self,
+        token: str,
+        api_url: str = TELEGRAM_API_URL,
+        max_concurrent_sends: int = RUNTIME_MAX_CONCURRENT_SENDS,
+        burst_limit: int = RUNTIME_SEND_BURST_LIMIT,
+        time_limit_ms: int = RUNTIME_SEND_TIME_LIMIT_MS,
+        max_retries: int = API_MAX_RETRIES
+    ) -> None:
+        self.base_url = f"{api_url}/bot{token}"
+        self.max_concurrent_sends = max_concurrent_sends
+        self.burst_limit = burst_limit
+        self.time_limit = time_limit_ms / 1000
+        self.max_retries = max_retries
+        # read by telegram.Message when replying
+        self.defaults = None
+        self.username: Optional[str] = None
+        self.client: Optional[httpx.AsyncClient] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.send_semaphore: Optional[asyncio.Semaphore] = None
+        # start times of the last burst_limit sends
+        self.sent_at: Deque[float] = deque()
+        self.pending_sends: Set[Future] = set()
+        self.sends = 0
+        self.send_errors = 0
+
+    async def __aenter__(self) -> "AsyncTelegramBot":
+        self.loop = asyncio.get_running_loop()
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(API_READ_TIMEOUT + RUNTIME_POLL_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=self.max_concurrent_sends + 1)
+        )
+        self.send_semaphore = asyncio.Semaphore(self.max_concurrent_sends)
+        me = await self.call("getMe")
+        self.username = me["username"]
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.drain()
+        await self.client.aclose()
+
+    async def call(self, method: str, **params) -> Any:
+        """POST a Bot API method, retrying when Telegram asks to slow down, and return its result."""
+        payload = {key: value for key, value in params.items() if value is not None}
+        for attempt in range(self.max_retries + 1):
+            response = await self.client.post(f"{self.base_url}/{method}", json=payload)
+            res_json = response.json()
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+            retry_after = res_json.get("parameters", {}).get("retry_after", 1)
+            logger.info(f"{method} rate limited, retrying in {retry_after}s")
+            await asyncio.sleep(retry_after)
+        if response.status_code != 200 or not res_json.get("ok"):
+            raise StatusCodeNot200(f"{method} result status {response.status_code}: {res_json.get('description')}")
+        return res_json["result"]
+
+    async def get_updates(self, offset: Optional[int], timeout: int) -> List[Dict]:
+        return await self.call("getUpdates", offset=offset, timeout=timeout)
+
+    async def set_webhook(self, url: str, secret_token: Optional[str], max_connections: int) -> None:
+        await self.call("setWebhook", url=url, secret_token=secret_token or None, max_connections=max_connections)
+
+    async def throttle(self) -> None:
+        """Wait until a send fits in the burst_limit per time_limit window."""
+        while len(self.sent_at) >= self.burst_limit:
+            wait = self.sent_at[0] + self.time_limit - time.monotonic()
+            if wait <= 0:
+                self.sent_at.popleft()
+            else:
+                await asyncio.sleep(wait)
+        self.sent_at.append(time.monotonic())
+
+    async def send(self, method: str, **params) -> Any:
+        async with self.send_semaphore:
+            await self.throttle()
+            return await self.call(method, **params)
+
+    def submit(self, method: str, **params) -> Future:
+        """Schedule a send on the event loop from any thread."""
+        params.pop("timeout", None)
+        params.update(params.pop("api_kwargs", None) or {})
+        # arguments the handlers left to the Bot defaults, which this bot does not have
+        params = {key: value for key, value in params.items() if not isinstance(value, DefaultValue)}
+        future = asyncio.run_coroutine_threadsafe(self.send(method, **params), self.loop)
+        self.pending_sends.add(future)
+        future.add_done_callback(self.send_done)
+        return future
+
+    def send_done(self, future: Future) -> None:
+        self.pending_sends.discard(future)
+        self.sends += 1
+        if not future.cancelled() and future.exception() is not None:
+            self.send_errors += 1
+            logger.error(f"Send failed: {future.exception()}")
+
+    def send_message(self, **kwargs) -> Future:
+        return self.submit("sendMessage", **kwargs)
+
+    def send_chat_action(self, **kwargs) -> Future:
+        return self.submit("sendChatAction", **kwargs)
+
+    async def drain(self) -> None:
+        """Wait for the sends already scheduled."""
+        while self.pending_sends:
+            await asyncio.gather(
+                *(asyncio.wrap_future(future) for future in list(self.pending_sends)), return_exceptions=True
+            )
+
+
+class RuntimeContext:
+    """What the handlers read from a CallbackContext."""
+
+    def __init__(self, bot: AsyncTelegramBot, args: Optional[List[str]] = None) -> None:
+        self.bot = bot
+        self.args = args
+        self.error: Optional[Exception] = None
+
+
+class AsyncBotRuntime:
+    """Runs the dispatcher handlers on an asyncio loop instead of the threaded Updater.
+
+    getUpdates is long polled and replies are sent with httpx, while the handlers (the CPU bound search) run on a
+    pool of worker threads. At most max_concurrent_updates updates are queued or running, once they are all taken
+    polling waits. Handlers and jobs are registered with the same calls as on a Dispatcher and its JobQueue.
+
+    The worker threads share the GIL, so they overlap the network waits but not two searches: searches only run
+    in parallel, and off the loop's interpreter, with SEARCH_EXECUTION_MODE = process_pool."""
+
+    def __init__(
+        self,
+        bot: AsyncTelegramBot,
+        workers: int = RUNTIME_WORKERS,
+        max_concurrent_updates: int = RUNTIME_MAX_CONCURRENT_UPDATES,
+        poll_timeout: int = RUNTIME_POLL_TIMEOUT
+    ) -> None:
+        self.bot = bot
+        self.workers = workers
+        self.max_concurrent_updates = max_concurrent_updates
+        self.poll_timeout = poll_timeout
+        self.handlers: List[Handler] = list()
+        self.error_handlers: List[Callable] = list()
+        self.jobs: List[Dict] = list()
+        self.job_queue = self
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.update_semaphore: Optional[asyncio.Semaphore] = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.stopping: Optional[asyncio.Event] = None
+        self.stopped = Event()
+        self.updates = 0
+
+    def add_handler(self, handler: Handler) -> None:
+        self.handlers.append(handler)
+
+    def add_error_handler(self, callback: Callable) -> None:
+        self.error_handlers.append(callback)
+
+    def run_repeating(self, callback: Callable, interval: float, first: float = 0) -> Dict:
+        job = {"callback": callback, "interval": interval, "first": first}
+        self.jobs.append(job)
+        return job
+
+    def run_once(self, callback: Callable, when: float) -> Dict:
+        job = {"callback": callback, "interval": None, "first": when}
+        self.jobs.append(job)
+        return job
+
+    def dispatch(self, update: Update) -> None:
+        """Run the first handler matching update, like a Dispatcher with all its handlers in one group."""
+        for handler in self.handlers:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            context = RuntimeContext(self.bot, check[0] if isinstance(check, tuple) else None)
+            try:
+                handler.callback(update, context)
+            except Exception as e:
+                context.error = e
+                if not self.error_handlers:
+                    logger.error(f"No error handler for: {e}")
+                    traceback.print_exc()
+                for error_handler in self.error_handlers:
+                    error_handler(update, context)
+            return
+
+    async def process_update(self, data: Dict) -> None:
+        try:
+            update = Update.de_json(data, self.bot)
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.dispatch, update)
+        except Exception as e:
+            logger.error(f"Update {data.get('update_id')} failed: {e}")
+            traceback.print_exc()
+        finally:
+            self.update_semaphore.release()
+
+    async def submit_update(self, data: Dict) -> None:
+        """Queue data for the workers, waits while max_concurrent_updates updates are already in."""
+        await self.update_semaphore.acquire()
+        self.updates += 1
+        task = asyncio.create_task(self.process_update(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def poll(self) -> None:
+        offset = None
+        errors = 0
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset, self.poll_timeout)
+                errors = 0
+            except (httpx.HTTPError, StatusCodeNot200) as e:
+                errors += 1
+                delay = min(2 ** errors, 60)
+                logger.error(f"getUpdates failed: {e}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                continue
+            for data in updates:
+                offset = data["update_id"] + 1
+                await self.submit_update(data)
+
+    async def run_job(self, job: Dict) -> None:
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(job["first"])
+        while True:
+            try:
+                await loop.run_in_executor(self.executor, job["callback"], RuntimeContext(self.bot))
+            except Exception as e:
+                logger.error(f"Job {job['callback']} failed: {e}")
+                traceback.print_exc()
+            if job["interval"] is None:
+                return
+            await asyncio.sleep(job["interval"])
+
+    async def serve(self) -> None:
+        """Where updates come from, long polling here."""
+        await self.poll()
+
+    async def run(self) -> None:
+        self.stopping = asyncio.Event()
+        self.stopped.clear()
+        self.update_semaphore = asyncio.Semaphore(self.max_concurrent_updates)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="runtime")
+        try:
+            async with self.bot:
+                logger.info(f"Async runtime started as {self.bot.username}")
+                background = [asyncio.create_task(self.serve())]
+                background += [asyncio.create_task(self.run_job(job)) for job in self.jobs]
+                await self.stopping.wait()
+                for task in background:
+                    task.cancel()
+                await asyncio.gather(*background, return_exceptions=True)
+                # the updates already taken are answered before closing
+                await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.stopped.set()
+            logger.info(f"Async runtime stopped after {self.updates} updates")
+
+    def stop(self) -> None:
+        """Stop from a thread other than the loop and the workers, returns once run is over."""
+        self.bot.loop.call_soon_threadsafe(self.stopping.set)
+        self.stopped.wait()
+
+
+class WebhookBotRuntime(AsyncBotRuntime):
+    """AsyncBotRuntime fed by Telegram posting updates to a local HTTP server instead of long polling.
+
+    Updates are answered 200 as soon as they are queued, the queue holds at most queue_size of them and when it is
+    full the request gets a 503, which Telegram retries later. Each worker takes up to batch_size queued updates
+    at once and handles them in a single executor call."""
+
+    MAX_BODY_BYTES = 1 << 20
+
+    def __init__(
+        self,
+        bot: AsyncTelegramBot,
+        listen: str = WEBHOOK_LISTEN,
+        port: int = WEBHOOK_PORT,
+        path: str = WEBHOOK_PATH,
+        url: str = WEBHOOK_URL,
+        secret_token: str = WEBHOOK_SECRET_TOKEN,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        workers: int = RUNTIME_WORKERS
+    ) -> None:
+        super().__init__(bot, workers=workers)
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.url = url
+        self.secret_token = secret_token
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.queue: Optional[asyncio.Queue] = None
+        # set once the server accepts connections, port then holds the bound one
+        self.listening = Event()
+        self.rejected = 0
+        self.batches = 0
+
+    def dispatch_batch(self, batch: List[Dict]) -> None:
+        for data in batch:
+            try:
+                self.dispatch(Update.de_json(data, self.bot))
+            except Exception as e:
+                logger.error(f"Update {data.get('update_id')} failed: {e}")
+                traceback.print_exc()
+
+    async def consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.batches += 1
+            try:
+                await loop.run_in_executor(self.executor, self.dispatch_batch, batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def accept(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, str]:
+        """Status and reason for a webhook request, queueing the update it carries."""
+        if method != "POST" or path != self.path:
+            return 404, "Not Found"
+        received_token = headers.get("x-telegram-bot-api-secret-token", "")
+        if self.secret_token and not hmac.compare_digest(received_token, self.secret_token):
+            return 403, "Forbidden"
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, "Bad Request"
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 503, "Service Unavailable"
+        self.updates += 1
+        return 200, "OK"
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Minimal HTTP/1.1, the requests on a connection are kept alive until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, *_ = request_line.decode("latin-1").split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > self.MAX_BODY_BYTES:
+                    status, reason = 413, "Payload Too Large"
+                else:
+                    status, reason = self.accept(method, path, headers, await reader.readexactly(length))
+                writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n\r\n".encode())
+                await writer.drain()
+                if status == 413 or headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.info(f"Webhook connection dropped: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        consumers = [asyncio.create_task(self.consume()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self.handle_connection, self.listen, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        if self.url:
+            await self.bot.set_webhook(self.url, self.secret_token, max_connections=min(self.queue_size, 100))
+        logger.info(f"Webhook listening on {self.listen}:{self.port}{self.path}")
+        self.listening.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            # the queued updates were already acknowledged, Telegram will not send them again
+            await self.queue.join()
+            for consumer in consumers:
+                consumer.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
@@ -14,10 +14,11 @@ from logic.logic import EpisodeHandler
 from support.configuration import LIST_OF_ADMINS, MINIMUM_SCORE
 from support.decorators import send_typing_action, check_effective_message
 from support.CallCounter import CallCounter
+from support.PersistenceWorker import PersistenceWorker
 from typing import List, Union, Tuple, Callable
 from utility.analytics import AnalyticsBackend
 from math import inf
-from functools import wraps
+from functools import partial, wraps
 from datetime import datetime, timezone
 
 logger = logging.getLogger("support.bot_support")
@@ -95,6 +96,12 @@ class FacadeBot:
         self.job_dump_cfg = None
         self.job_dump_wc = None
         self.job_dump_cc = None
+        # the jobs only ask for a dump, the worker writes the snapshots off the job queue thread
+        self.persistence = PersistenceWorker()
+        self.persistence.register("dump_cfg", SearchConfigs.snapshot_for_dump)
+        self.persistence.register("dump_search", self.episode_handler.word_counter.snapshot_for_dump)
+        self.persistence.register("dump_call", self.call_counter.snapshot_for_dump)
+        self.persistence.start()
 
     @staticmethod
     def is_admin(chat_id: int) -> bool:
@@ -322,28 +329,26 @@ class FacadeBot:
         )
 
         self.job_dump_cfg = job_queue.run_repeating(
-            callback=SearchConfigs.dump_data,
+            callback=partial(self.persistence.request, "dump_cfg"),
             interval=60 * 60 * 6,
             first=30,
         )
 
         self.job_dump_wc = job_queue.run_repeating(
-            callback=self.episode_handler.save_searches,
+            callback=partial(self.persistence.request, "dump_search"),
             interval=60 * 60,
             first=90
         )
 
         self.job_dump_cc = job_queue.run_repeating(
-            callback=self.call_counter.dump_data,
+            callback=partial(self.persistence.request, "dump_call"),
             interval=60 * 60,
             first=120
         )        
 
     def dump_data(self, update: Update, context: CallbackContext):
-        res_dump_cfg = SearchConfigs.dump_data()
-        res_dump_search = self.episode_handler.save_searches()
-        res_dump_call = self.call_counter.dump_data()
-        return zip([res_dump_cfg, res_dump_search, res_dump_call], ['dump_cfg', 'dump_search', 'dump_call'])
+        results = self.persistence.flush()
+        return zip(results.values(), results.keys())
 
     @check_effective_message
     def start(self, update: Update, context: CallbackContext) -> None:
@@ -414,6 +419,26 @@ class FacadeBot:
             ) + msg
         )
 
+    @check_effective_message
+    def get_query_cache_stats(self, update: Update, context: CallbackContext) -> None:
+        assert update.effective_message is not None  # for mypy, real check is in decorator
+
+        stats = self.analytics.get_query_cache_stats()
+
+        update.effective_message.reply_text(
+            TextRepo.MSG_QUERY_CACHE_STATS.format(**stats)
+        )
+
+    @check_effective_message
+    def get_persistence_stats(self, update: Update, context: CallbackContext) -> None:
+        assert update.effective_message is not None  # for mypy, real check is in decorator
+
+        stats = self.persistence.stats()
+
+        update.effective_message.reply_text(
+            "\n\n".join(TextRepo.MSG_PERSISTENCE_STATS.format(name=name, **store) for name, store in stats.items())
+        )
+
     @check_effective_message
     def memo(self, update: Update, context: CallbackContext) -> None:
         assert update.effective_message is not None  # for mypy, real check is in decorator
@@ -1,6 +1,7 @@
 import pathlib
 import os
 import configparser
+import math
 from typing import Set, Tuple
 
 SRC_FOLDER = pathlib.Path(__file__).parent.parent.absolute()
@@ -16,13 +17,32 @@ else:
 LOG_FILEPATH = os.path.join(SRC_FOLDER, config["PATH"].get("LOGGER_FILEPATH"))
 
 CACHE_FILEPATH: str = os.path.join(SRC_FOLDER, config["PATH"].get("CACHE_FILEPATH"))
+CACHE_FORMAT: str = config["PATH"].get("CACHE_FORMAT", "json")
+CACHE_JOURNAL_COMPACT_EVERY: int = int(config["PATH"].get("CACHE_JOURNAL_COMPACT_EVERY", "50"))
+CACHE_DB_FILEPATH: str = os.path.join(
+    SRC_FOLDER, config["PATH"].get("CACHE_DB_FILEPATH", os.path.splitext(CACHE_FILEPATH)[0] + ".sqlite3")
+)
+API_VALIDATORS_FILEPATH: str = os.path.join(
+    SRC_FOLDER, config["PATH"].get("API_VALIDATORS_FILEPATH", os.path.join(os.path.dirname(CACHE_FILEPATH), "api_validators.json"))
+)
 
 WORD_COUNTER_FILEPATH: str = os.path.join(
     SRC_FOLDER, config["PATH"].get("WORD_COUNT_FILEPATH")
 )
-CALL_COUNTER_FILEPATH: str = os.path.join(
+# "exact" keeps every query, "space_saving" keeps the heavy hitters with counts off by at most EPSILON * searches
+WORD_COUNTER_MODE: str = config.get("WORD_COUNTER", "MODE", fallback="exact")
+WORD_COUNTER_EPSILON: float = config.getfloat("WORD_COUNTER", "EPSILON", fallback=0.0001)
+WORD_COUNTER_CAPACITY: int = config.getint(
+    "WORD_COUNTER", "CAPACITY", fallback=int(math.ceil(1 / WORD_COUNTER_EPSILON))
+)
+# the old JSON store, converted once into the log below and then renamed with a .migrated suffix
+LEGACY_CALL_COUNTER_FILEPATH: str = os.path.join(
     SRC_FOLDER, config["PATH"].get("CALL_COUNT_FILEPATH")
 )
+CALL_COUNTER_FILEPATH: str = os.path.join(
+    SRC_FOLDER,
+    config["PATH"].get("CALL_COUNT_LOG_FILEPATH", f"{os.path.splitext(LEGACY_CALL_COUNTER_FILEPATH)[0]}.log")
+)
 
 USERS_CFG_FOLDER: str = os.path.join(
     SRC_FOLDER,
@@ -36,5 +56,50 @@ LIST_OF_ADMINS: Set[int] = set(
     [int(admin_id) for key, admin_id in config.items("ADMINS")]
 )
 MINIMUM_SCORE = 70
+# a chat still under its legacy key costs abs(chat_id) bytes of sha1 on its first lookup (about 1s per GiB), bigger
+# ids are not recomputed and their configs stay under the legacy key
+LEGACY_CHAT_ID_HASH_MAX_BYTES: int = config.getint("USERS", "LEGACY_CHAT_ID_HASH_MAX_BYTES", fallback=1 << 33)
+
+API_MAX_IN_FLIGHT: int = config.getint("API", "MAX_IN_FLIGHT", fallback=8)
+API_MAX_RETRIES: int = config.getint("API", "MAX_RETRIES", fallback=5)
+API_BACKOFF_FACTOR: float = config.getfloat("API", "BACKOFF_FACTOR", fallback=0.5)
+API_CONNECT_TIMEOUT: float = config.getfloat("API", "CONNECT_TIMEOUT", fallback=5)
+API_READ_TIMEOUT: float = config.getfloat("API", "READ_TIMEOUT", fallback=30)
+POLL_PAGE_SIZE: int = config.getint("API", "POLL_PAGE_SIZE", fallback=10)
+INGESTION_MODE: str = config.get("API", "INGESTION_MODE", fallback="sync")
+INGESTION_BATCH_SIZE: int = config.getint("API", "INGESTION_BATCH_SIZE", fallback=50)
+
+SCORING_MODE: str = config.get("SEARCH", "SCORING_MODE", fallback="combinations")
+MAX_QUERY_WORDS: int = config.getint("SEARCH", "MAX_QUERY_WORDS", fallback=8)
+MAX_NGRAM_SIZE: int = config.getint("SEARCH", "MAX_NGRAM_SIZE", fallback=3)
+# score only the topics sharing a trigram with the query, a bit faster but it can miss topics that tie for the best
+# score, so it is off unless asked for
+SEARCH_SHORTLIST: bool = config.getboolean("SEARCH", "SHORTLIST", fallback=False)
+# a shortlist whose best score is below this may have missed the best topic, the search then scores every topic
+SHORTLIST_MIN_SCORE: int = config.getint("SEARCH", "SHORTLIST_MIN_SCORE", fallback=60)
+QUERY_CACHE_SIZE: int = config.getint("SEARCH", "QUERY_CACHE_SIZE", fallback=512)
+SEARCH_EXECUTION_MODE: str = config.get("SEARCH", "EXECUTION_MODE", fallback="serial")
+SEARCH_WORKERS: int = config.getint("SEARCH", "WORKERS", fallback=os.cpu_count() or 1)
+
+# "polling" runs the threaded Updater, "asyncio" the AsyncBotRuntime, "webhook" the WebhookBotRuntime.
+# The asyncio and webhook handlers run on RUNTIME_WORKERS threads, searches only run in parallel (the threads share
+# the GIL) with [SEARCH] EXECUTION_MODE = process_pool
+RUNTIME_MODE: str = config.get("RUNTIME", "MODE", fallback="polling")
+TELEGRAM_API_URL: str = config.get("RUNTIME", "TELEGRAM_API_URL", fallback="https://api.telegram.org")
+RUNTIME_WORKERS: int = config.getint("RUNTIME", "WORKERS", fallback=4)
+RUNTIME_MAX_CONCURRENT_UPDATES: int = config.getint("RUNTIME", "MAX_CONCURRENT_UPDATES", fallback=32)
+RUNTIME_MAX_CONCURRENT_SENDS: int = config.getint("RUNTIME", "MAX_CONCURRENT_SENDS", fallback=8)
+RUNTIME_POLL_TIMEOUT: int = config.getint("RUNTIME", "POLL_TIMEOUT", fallback=30)
+# same flood limits the MessageQueue of the polling mode applies
+RUNTIME_SEND_BURST_LIMIT: int = config.getint("RUNTIME", "SEND_BURST_LIMIT", fallback=29)
+RUNTIME_SEND_TIME_LIMIT_MS: int = config.getint("RUNTIME", "SEND_TIME_LIMIT_MS", fallback=1017)
+WEBHOOK_LISTEN: str = config.get("RUNTIME", "WEBHOOK_LISTEN", fallback="0.0.0.0")
+WEBHOOK_PORT: int = config.getint("RUNTIME", "WEBHOOK_PORT", fallback=8443)
+WEBHOOK_PATH: str = config.get("RUNTIME", "WEBHOOK_PATH", fallback="/webhook")
+# public address Telegram posts to, setWebhook is left alone when empty
+WEBHOOK_URL: str = config.get("RUNTIME", "WEBHOOK_URL", fallback="")
+WEBHOOK_SECRET_TOKEN: str = config.get("RUNTIME", "WEBHOOK_SECRET_TOKEN", fallback="")
+WEBHOOK_QUEUE_SIZE: int = config.getint("RUNTIME", "WEBHOOK_QUEUE_SIZE", fallback=64)
+WEBHOOK_BATCH_SIZE: int = config.getint("RUNTIME", "WEBHOOK_BATCH_SIZE", fallback=8)
 
 CREATOR_TELEGRAM_ID = config["SECRET"].get("CREATOR_TELEGRAM_ID")
\ No newline at end of file
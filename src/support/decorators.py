@@ -4,26 +4,45 @@ import traceback
 
 from telegram import Update, Bot, ParseMode, ChatAction
 from telegram.ext import CallbackContext
-from typing import Callable
-from functools import wraps
-from support.configuration import LIST_OF_ADMINS
+from typing import Callable, Optional
+from functools import wraps, lru_cache
+from support.configuration import LIST_OF_ADMINS, LEGACY_CHAT_ID_HASH_MAX_BYTES
 from model.custom_exceptions import UpdateEffectiveMsgNotFound
 import logging
-from hashlib import sha1
+from hashlib import sha1, blake2b
 import math
 
 logger = logging.getLogger("decorators")
 
+LEGACY_HASH_CHUNK = bytes(1 << 20)
+
+@lru_cache(maxsize=1 << 16)
+def chat_id_digest(chat_id: int) -> bytes:
+    # 16 bytes, legacy keys have 20 so the two schemes can't be mistaken for each other
+    return blake2b(str(chat_id).encode(), digest_size=16).digest()
+
+def legacy_chat_id_digest(chat_id: int) -> Optional[bytes]:
+    """The old sha1(bytes(abs(chat_id))) key, hashed a chunk of zeros at a time. None if it would take too long."""
+    n_bytes = abs(chat_id)
+    if n_bytes > LEGACY_CHAT_ID_HASH_MAX_BYTES:
+        return None
+    hasher = sha1()
+    full_chunks, rest = divmod(n_bytes, len(LEGACY_HASH_CHUNK))
+    for _ in range(full_chunks):
+        hasher.update(LEGACY_HASH_CHUNK)
+    hasher.update(LEGACY_HASH_CHUNK[:rest])
+    return hasher.digest()
+
 def hash_chat_id(func: Callable) -> Callable:
-    
+    """Passes chat_id_digest(chat_id) to func instead of the chat id. If the class still holds keys made with the
+    legacy scheme (cls._legacy_keys), cls.migrate_legacy_key gets the chance to move the chat to its new key."""
+
     @wraps(func)
     def wrapped_func(cls, chat_id: int, *args, **kwargs):
-        try:
-            hashed_chat_id = sha1(bytes(abs(chat_id))).hexdigest()
-            return func(cls, hashed_chat_id, *args, **kwargs)
-        except MemoryError as me:
-            logger.error(f"Chat_id {chat_id} caused a Memory Error, gonna hash bytes(1): {me}")
-            return func(cls, sha1(bytes(1)).hexdigest(), *args, **kwargs)
+        hashed_chat_id = chat_id_digest(chat_id)
+        if getattr(cls, "_legacy_keys", None):
+            cls.migrate_legacy_key(chat_id, hashed_chat_id)
+        return func(cls, hashed_chat_id, *args, **kwargs)
 
     return wrapped_func
 
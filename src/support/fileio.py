@@ -0,0 +1,66 @@
+import os
+import json
+import logging
+from typing import Dict, Iterable, List
+
+logger = logging.getLogger("support.fileio")
+
+
+def fsync_directory(dirpath: str) -> None:
+    # makes a rename durable, not every platform lets you open a directory
+    try:
+        fd = os.open(dirpath or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_text(filepath: str, text: str) -> int:
+    """Write text to a temporary file, fsync it and rename it over filepath. Returns the bytes written."""
+    tmp_filepath = f"{filepath}.tmp"
+    data = text.encode("utf-8")
+    with open(tmp_filepath, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, filepath)
+    fsync_directory(os.path.dirname(filepath))
+    return len(data)
+
+
+def append_lines(filepath: str, lines: Iterable[str]) -> int:
+    """Append one line per element to filepath and fsync it. Returns the bytes written."""
+    data = "".join(f"{line}\n" for line in lines).encode("utf-8")
+    with open(filepath, "ab+") as f:
+        # a previous append cut short by a crash must not swallow the first new line
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+
+def read_json_lines(filepath: str) -> List[Dict]:
+    """One object per line of filepath, a missing file is empty. Lines cut short by a crash are skipped."""
+    entries = list()
+    try:
+        with open(filepath, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # an append cut short by a crash, it was never acknowledged
+                    logger.error(f"{filepath} has a truncated entry, skipping it.")
+    except FileNotFoundError:
+        pass
+    return entries
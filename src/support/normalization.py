@@ -0,0 +1,29 @@
+from typing import FrozenSet, List, Set
+
+from stop_words import get_stop_words
+from unidecode import unidecode
+
+IT_STOP_WORDS: Set[str] = set(get_stop_words('it'))
+EN_STOP_WORDS: Set[str] = set(get_stop_words('en'))
+STOP_WORDS: FrozenSet[str] = frozenset(IT_STOP_WORDS | EN_STOP_WORDS)
+
+# unidecode always gives back ascii, so every ascii char but letters, digits and space becomes a separator
+_SEPARATORS_TABLE = str.maketrans({chr(c): " " for c in range(128) if not chr(c).isalnum() and chr(c) != " "})
+
+
+def normalize_text(s: str, remove_stop_words: bool = True) -> str:
+    """
+    Lowercase, transliterate to ascii, turn anything not alphanumeric into a single space and,
+    if requested, drop italian and english stop words, all in one pass over the tokens.
+    """
+    s = s.lower()
+    if not s.isascii():
+        s = unidecode(s)
+    words = s.translate(_SEPARATORS_TABLE).split()
+    if remove_stop_words:
+        words = [word for word in words if word not in STOP_WORDS]
+    return " ".join(words)
+
+
+def tokenize(normalized_text: str) -> List[str]:
+    return normalized_text.split(" ")
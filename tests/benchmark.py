@@ -0,0 +1,251 @@
+"""
+Micro-benchmarks for the hot paths of the bot, run them with
+
+    python tests/benchmark.py [name ...]
+
+They are not collected by pytest.
+"""
+import os
+import sys
+os.environ["PPB_ENV"] = "unittest"
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../src/')
+import asyncio
+import random
+import re
+import time
+import timeit
+import tracemalloc
+from collections import defaultdict
+from hashlib import sha1
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Callable, Dict, List
+
+from unidecode import unidecode
+
+from support.normalization import normalize_text, IT_STOP_WORDS, EN_STOP_WORDS
+from support.decorators import chat_id_digest
+from model.models import SearchConfigs
+from support.SpaceSavingCounter import SpaceSavingCounter
+
+WORDS = (
+    "il la della nel con per tra dark souls hollow knight zerocalcare babbo morto kenobit twitch luca "
+    "celestepedone gioco film serie netflix anime manga fumetto marvel batman elden ring zelda breath "
+    "wild mario kart pokémon spada scudo final fantasy resident evil però così più perché città"
+).split()
+
+
+def random_labels(n: int, seed: int = 42) -> List[str]:
+    rnd = random.Random(seed)
+    return [
+        " ".join(rnd.choice(WORDS).capitalize() for _ in range(rnd.randint(2, 8))) + rnd.choice(["", " - Wow!!", "?", " (2020)"])
+        for _ in range(n)
+    ]
+
+
+def report(name: str, timings: Dict[str, float], n: int) -> None:
+    print(f"\n{name}")
+    baseline = next(iter(timings.values()))
+    for label, seconds in timings.items():
+        print(f"  {label:<30} {seconds / n * 1e6:10.2f} us/op   x{baseline / seconds:.1f}")
+
+
+############## normalization ##############
+
+def legacy_normalize_string(s: str) -> str:
+    s = unidecode(s.lower())
+    s = re.sub("[^A-Za-z0-9 ]+", " ", s)
+    for word in s.split(" "):
+        if word in EN_STOP_WORDS or word in IT_STOP_WORDS:
+            s = re.sub(r"\b{}\b".format(word), "", s)
+    s = re.sub("[ ]+", " ", s).strip()
+
+    return s
+
+
+def bench_normalize_string() -> None:
+    labels = random_labels(5000)
+    assert [legacy_normalize_string(label) for label in labels] == [normalize_text(label) for label in labels]
+
+    timings = {
+        "legacy regex per stop word": timeit.timeit(lambda: [legacy_normalize_string(label) for label in labels], number=3),
+        "single pass": timeit.timeit(lambda: [normalize_text(label) for label in labels], number=3),
+    }
+    report("normalize_string", timings, 3 * len(labels))
+
+
+############## user configs ##############
+
+class LegacyUserConfig:
+    def __init__(self, n, m):
+        self.n = n
+        self.m = m
+
+
+def allocated_bytes(build: Callable[[], object]) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def bench_user_configs(n_users: int = 100_000, custom_share: float = 0.1) -> None:
+    # chat ids that only searched (defaults) and the ones that changed /top
+    chat_ids = random.Random(42).sample(range(10 ** 8, 10 ** 10), n_users)
+    n_custom = int(n_users * custom_share)
+
+    def build_legacy():
+        # every read materializes an entry, keyed by a 40 char hex string
+        user_data = defaultdict(lambda: LegacyUserConfig(5, 1))
+        for chat_id in chat_ids:
+            user_data[sha1(str(chat_id).encode()).hexdigest()]
+        for chat_id in chat_ids[:n_custom]:
+            user_data[sha1(str(chat_id).encode()).hexdigest()].n = 10
+        return user_data
+
+    def build_compact():
+        SearchConfigs.reset_user_data()
+        chat_id_digest.cache_clear()
+        for chat_id in chat_ids:
+            SearchConfigs.lookup_user_cfg(chat_id_digest(chat_id))
+        for chat_id in chat_ids[:n_custom]:
+            SearchConfigs.apply_user_cfg(chat_id_digest(chat_id), 10, "n")
+        chat_id_digest.cache_clear()
+        return SearchConfigs._user_data, SearchConfigs._seen_users
+
+    print(f"\nuser configs, {n_users} users, {n_custom} with a custom config")
+    for label, build in (("legacy defaultdict", build_legacy), ("slots + digest keys", build_compact)):
+        n_bytes = allocated_bytes(build)
+        print(f"  {label:<30} {n_bytes / n_users:10.1f} bytes/user   {n_bytes / 2 ** 20:8.2f} MiB")
+    SearchConfigs.reset_user_data()
+
+
+############## word counter ##############
+
+def bench_word_counter(n_distinct: int = 1_000_000, capacity: int = 10_000) -> None:
+    # a few hundred popular queries searched often, plus a long tail of queries searched once
+    rnd = random.Random(42)
+    popular = [" ".join(rnd.sample(WORDS, 2)) for i in range(300)]
+    # negative ids are popular queries, the strings are built while counting so each counter pays for its own keys
+    stream = list(range(n_distinct))
+    stream += [-(int(rnd.paretovariate(1.2)) % len(popular)) - 1 for _ in range(n_distinct // 2)]
+    rnd.shuffle(stream)
+
+    def query(i: int) -> str:
+        return f"{popular[-i - 1]} {-i}" if i < 0 else f"typo {i}"
+
+    def build_exact():
+        counter = Counter()
+        for i in stream:
+            counter[query(i)] += 1
+        return counter
+
+    def build_sketch():
+        sketch = SpaceSavingCounter(capacity)
+        for i in stream:
+            sketch.add(query(i))
+        return sketch
+
+    print(f"\nword counter, {len(stream)} searches, {len(set(stream))} distinct queries, sketch capacity {capacity}")
+    counters = dict()
+    for label, build in (("exact Counter", build_exact), ("space saving", build_sketch)):
+        n_bytes = allocated_bytes(build)
+        counters[label] = build()
+        print(f"  {label:<30} {n_bytes / 2 ** 20:8.2f} MiB")
+
+    exact, sketch = counters["exact Counter"], counters["space saving"]
+    top_exact = [query for query, count in exact.most_common(20)]
+    top_sketch = [query for query, count in sketch.most_common(20)]
+    print(f"  top 20 agreement {len(set(top_exact) & set(top_sketch))}/20, error bound {sketch.error_bound():.0f}")
+
+    timings = {
+        "exact most_common(20)": timeit.timeit(lambda: exact.most_common(20), number=20),
+        "sketch most_common(20)": timeit.timeit(lambda: sketch.most_common(20), number=20),
+    }
+    report("/ncw most_common", timings, 20)
+
+
+############## runtime ##############
+
+def bench_runtime(n_updates: int = 400, send_delay: float = 0.02, search_seconds: float = 0.002) -> None:
+    """Updates/sec and reply latency of the threaded Updater, the asyncio runtime and the webhook runtime against
+    the fake Telegram API.
+
+    Every send takes send_delay on the fake server, the handler sends a chat action, spins search_seconds of CPU
+    and replies, like /s. The bots run without the flood limits, which would cap them at 29 messages/sec.
+    The webhook gets the updates posted by 8 connections at once, the latency counts from each post."""
+    from telegram import Bot
+    from telegram.ext import CommandHandler, Updater
+    from telegram.utils.request import Request
+    from support.async_runtime import AsyncTelegramBot, AsyncBotRuntime, WebhookBotRuntime
+    from fake_telegram import FakeTelegramServer, make_update
+
+    def search(update, context):
+        context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action="typing")
+        deadline = time.perf_counter() + search_seconds
+        while time.perf_counter() < deadline:
+            pass
+        update.effective_message.reply_text("result")
+
+    def run_threaded(server: FakeTelegramServer) -> None:
+        bot = Bot("123:abc", base_url=f"{server.url}/bot", request=Request(con_pool_size=8))
+        updater = Updater(bot=bot, use_context=True, workers=4)
+        updater.dispatcher.add_handler(CommandHandler("s", search))
+        updater.start_polling(poll_interval=0, timeout=1)
+        server.wait_for_messages(n_updates, timeout=120)
+        updater.stop()
+
+    def run_async(server: FakeTelegramServer) -> None:
+        runtime = AsyncBotRuntime(AsyncTelegramBot("123:abc", api_url=server.url, burst_limit=10 ** 6), workers=4)
+        runtime.add_handler(CommandHandler("s", search))
+        thread = Thread(target=asyncio.run, args=(runtime.run(),))
+        thread.start()
+        server.wait_for_messages(n_updates, timeout=120)
+        runtime.stop()
+
+    def run_webhook(server: FakeTelegramServer) -> None:
+        runtime = WebhookBotRuntime(
+            AsyncTelegramBot("123:abc", api_url=server.url, burst_limit=10 ** 6),
+            listen="127.0.0.1", port=0, workers=4, queue_size=n_updates
+        )
+        runtime.add_handler(CommandHandler("s", search))
+        thread = Thread(target=asyncio.run, args=(runtime.run(),))
+        thread.start()
+        runtime.listening.wait(5)
+        webhook_url = f"http://127.0.0.1:{runtime.port}{runtime.path}"
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda update: server.deliver(webhook_url, update), server.updates))
+        server.wait_for_messages(n_updates, timeout=120)
+        runtime.stop()
+
+    print(f"\nruntime, {n_updates} updates, {send_delay * 1000:.0f}ms per send, {search_seconds * 1000:.0f}ms of search")
+    for label, run in (("threaded Updater", run_threaded), ("asyncio runtime", run_async), ("webhook runtime", run_webhook)):
+        server = FakeTelegramServer(send_delay=send_delay).start()
+        for i in range(n_updates):
+            server.push_update(make_update(i, 10 ** 6 + i, "/s dark souls"))
+        start = time.perf_counter()
+        run(server)
+        elapsed = time.perf_counter() - start
+        latencies = sorted(server.reply_latencies())
+        server.stop()
+        print(
+            f"  {label:<30} {len(latencies) / elapsed:8.1f} updates/s"
+            f"   p50 {latencies[len(latencies) // 2] * 1000:7.1f}ms   p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.1f}ms"
+        )
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    "normalize_string": bench_normalize_string,
+    "user_configs": bench_user_configs,
+    "word_counter": bench_word_counter,
+    "runtime": bench_runtime,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
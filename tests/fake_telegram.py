@@ -0,0 +1,149 @@
+"""
+A local stand-in for the Telegram Bot API, shared by the runtime tests and tests/benchmark.py.
+
+Updates pushed with push_update are served by getUpdates (long polled) and can be posted to a webhook, every
+sendMessage and sendChatAction is recorded, after send_delay seconds to play the part of the network.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+from typing import Dict, List, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import json
+import time
+
+BOT_USERNAME = "fake_bot"
+
+
+def make_update(update_id: int, chat_id: int, text: str, username: str = "user") -> Dict:
+    """A private chat text message, with the bot_command entity Telegram adds when text starts with /."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": username, "username": username},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server: FakeTelegramServer = self.server
+        method = self.path.rstrip("/").split("/")[-1]
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        # python-telegram-bot sends numbers as strings
+        if "chat_id" in payload:
+            payload["chat_id"] = int(payload["chat_id"])
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": BOT_USERNAME}
+        elif method == "getUpdates":
+            offset = payload.get("offset")
+            result = server.get_updates(None if offset is None else int(offset), float(payload.get("timeout") or 0))
+        elif method in ("sendMessage", "sendChatAction"):
+            time.sleep(server.send_delay)
+            server.record(method, payload)
+            result = True if method == "sendChatAction" else {
+                "message_id": 1, "date": int(time.time()), "chat": {"id": payload["chat_id"], "type": "private"},
+                "text": payload.get("text", "")
+            }
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, send_delay: float = 0.0, max_poll_wait: float = 0.5) -> None:
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.send_delay = send_delay
+        # getUpdates never holds a request longer than this, so stopping a poller is quick
+        self.max_poll_wait = max_poll_wait
+        self.condition = Condition()
+        self.updates: List[Dict] = list()
+        # update chat id -> time it was pushed
+        self.pushed_at: Dict[int, float] = dict()
+        self.sent: List[Tuple[str, Dict, float]] = list()
+        self.thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeTelegramServer":
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def push_update(self, update: Dict) -> None:
+        with self.condition:
+            self.pushed_at[update["message"]["chat"]["id"]] = time.perf_counter()
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def deliver(self, webhook_url: str, update: Dict, secret_token: Optional[str] = None) -> int:
+        """Post update to a webhook like Telegram does, returns the status code."""
+        headers = {"Content-Type": "application/json"}
+        if secret_token:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = secret_token
+        with self.condition:
+            self.pushed_at[update["message"]["chat"]["id"]] = time.perf_counter()
+        try:
+            with urlopen(Request(webhook_url, data=json.dumps(update).encode(), headers=headers)) as response:
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def get_updates(self, offset: Optional[int], timeout: float) -> List[Dict]:
+        deadline = time.monotonic() + min(timeout, self.max_poll_wait)
+        with self.condition:
+            if offset is not None:
+                # like Telegram, asking for an offset confirms the updates before it
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return list(self.updates[:100])
+
+    def record(self, method: str, payload: Dict) -> None:
+        with self.condition:
+            self.sent.append((method, payload, time.perf_counter()))
+            self.condition.notify_all()
+
+    def messages(self) -> List[Dict]:
+        with self.condition:
+            return [payload for method, payload, sent_at in self.sent if method == "sendMessage"]
+
+    def wait_for_messages(self, n: int, timeout: float = 10) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while sum(method == "sendMessage" for method, payload, sent_at in self.sent) < n:
+                if time.monotonic() >= deadline:
+                    return False
+                self.condition.wait(deadline - time.monotonic())
+            return True
+
+    def reply_latencies(self) -> List[float]:
+        """Seconds from each update being pushed to the first message sent to its chat."""
+        first_reply: Dict[int, float] = dict()
+        with self.condition:
+            for method, payload, sent_at in self.sent:
+                if method == "sendMessage":
+                    first_reply.setdefault(payload["chat_id"], sent_at)
+            return [first_reply[chat_id] - pushed for chat_id, pushed in self.pushed_at.items() if chat_id in first_reply]
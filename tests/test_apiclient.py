@@ -0,0 +1,262 @@
+import os
+import sys
+os.environ["PPB_ENV"] = "unittest"
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../src/')
+import pytest
+from support.apiclient import SpreakerAPIClient
+from support.async_apiclient import AsyncSpreakerAPIClient
+from support.WordCounter import WordCounter
+from support.Cacher import Cacher
+from logic.logic import EpisodeHandler
+from model.models import Show
+from model.custom_exceptions import StatusCodeNot200
+from support.TextRepo import TextRepo
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from threading import Lock, Thread
+from unittest.mock import patch
+from urllib.parse import urlparse, parse_qs
+import asyncio
+import httpx
+import json
+import os
+import tempfile
+import time
+
+############## fixtures ##############
+
+class StubSpreakerHandler(BaseHTTPRequestHandler):
+    """Serves /v2/episodes/<id>, answering 429 to the first request of every id listed in rate_limited,
+    and late to the first one of every id in slow, and the pages of feed_pages from /v2/shows/<id>/episodes
+    with an ETag."""
+    rate_limited = set()
+    slow = set()
+    delay = 0.0
+    requests = Counter()
+    in_flight = 0
+    max_in_flight = 0
+    lock = Lock()
+    etag = '"v1"'
+    feed_pages = [[{"episode_id": 1}]]
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", StubSpreakerHandler.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if "/shows/" in self.path:
+            StubSpreakerHandler.requests["feed"] += 1
+            if self.headers.get("If-None-Match") == StubSpreakerHandler.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            n_page = int(parse_qs(urlparse(self.path).query).get("page", ["0"])[0])
+            next_url = None
+            if n_page + 1 < len(StubSpreakerHandler.feed_pages):
+                next_url = f"http://{self.headers['Host']}{urlparse(self.path).path}?page={n_page + 1}"
+            return self.send_json({"response": {"items": StubSpreakerHandler.feed_pages[n_page], "next_url": next_url}})
+        episode_id = self.path.rstrip("/").split("/")[-1]
+        cls = StubSpreakerHandler
+        with cls.lock:
+            cls.requests[episode_id] += 1
+            n_request = cls.requests[episode_id]
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            time.sleep(cls.delay)
+            if episode_id in cls.slow and n_request == 1:
+                time.sleep(0.5)
+            if episode_id in cls.rate_limited and n_request == 1:
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                return
+            description = f"descr {episode_id}\n\nTopic {episode_id}\nhttps://example.com/{episode_id}\n"
+            self.send_json({"response": {"episode": {"episode_id": episode_id, "description": description}}})
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_server():
+    StubSpreakerHandler.rate_limited = set()
+    StubSpreakerHandler.slow = set()
+    StubSpreakerHandler.delay = 0.0
+    StubSpreakerHandler.requests = Counter()
+    StubSpreakerHandler.in_flight = 0
+    StubSpreakerHandler.max_in_flight = 0
+    StubSpreakerHandler.feed_pages = [[{"episode_id": 1}]]
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSpreakerHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v2"
+    with patch.object(SpreakerAPIClient, "GET_SINGLE_EPISODE_URL", base_url + "/episodes/{}"), \
+            patch.object(SpreakerAPIClient, "GET_SHOW_EPISODES_URL", base_url + "/shows/{}/episodes"):
+        yield StubSpreakerHandler
+    server.shutdown()
+    server.server_close()
+
+############## tests ##############
+
+class TestSpreakerAPIClient:
+
+    def test_get_episodes_info(self, stub_server):
+        client = SpreakerAPIClient("testtoken", max_in_flight=4)
+        episode_ids = [str(i) for i in range(20)]
+        infos = client.get_episodes_info(episode_ids)
+        assert list(infos.keys()) == episode_ids
+        for episode_id in episode_ids:
+            assert infos[episode_id]["response"]["episode"]["description"].startswith(f"descr {episode_id}\n")
+
+    def test_get_episodes_info_bounded_concurrency(self, stub_server):
+        stub_server.delay = 0.05
+        client = SpreakerAPIClient("testtoken", max_in_flight=3)
+        client.get_episodes_info([str(i) for i in range(12)])
+        assert 1 < stub_server.max_in_flight <= 3
+
+    def test_get_episode_info_retries_rate_limit(self, stub_server):
+        stub_server.rate_limited = {"1", "3"}
+        client = SpreakerAPIClient("testtoken", max_in_flight=2)
+        infos = client.get_episodes_info(["1", "2", "3"])
+        assert infos["3"]["response"]["episode"]["description"].startswith("descr 3\n")
+        assert stub_server.requests == Counter({"1": 2, "2": 1, "3": 2})
+
+    def test_get_episode_info_gives_up(self, stub_server):
+        stub_server.rate_limited = {"1"}
+        client = SpreakerAPIClient("testtoken", max_retries=0)
+        with pytest.raises(StatusCodeNot200):
+            client.get_episode_info("1")
+
+    def test_stats_count_calls_and_retries(self, stub_server):
+        stub_server.rate_limited = {"2"}
+        client = SpreakerAPIClient("testtoken")
+        client.get_episodes_info(["1", "2"])
+        stats = client.stats()["get_episode_info"]
+        assert stats["calls"] == 2
+        assert stats["retries"] == 1
+        assert stats["max_seconds"] <= stats["total_seconds"]
+
+    def test_session_sends_auth_header(self):
+        client = SpreakerAPIClient("testtoken")
+        assert client.session.headers["Authorization"] == "Bearer testtoken"
+
+    def test_get_last_n_episode_conditional(self, stub_server):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            validators_filepath = os.path.join(tmpdirname, "validators.json")
+            client = SpreakerAPIClient("testtoken", validators_filepath=validators_filepath)
+            assert client.get_last_n_episode("42", 10) == [{"episode_id": 1}]
+            # not committed yet, so the next poll still downloads the feed
+            assert client.get_last_n_episode("42", 10) == [{"episode_id": 1}]
+            client.commit_validators()
+            assert client.get_last_n_episode("42", 10) is None
+
+            # validators survive a restart
+            client = SpreakerAPIClient("testtoken", validators_filepath=validators_filepath)
+            assert client.get_last_n_episode("42", 10) is None
+            assert client.get_last_n_episode("42", 20) == [{"episode_id": 1}]
+            assert stub_server.requests["feed"] == 5
+
+
+def raw_feed_pages(n_pages, page_size):
+    return [
+        [
+            {
+                "episode_id": page * page_size + i,
+                "title": f"Ep.{page * page_size + i}: Titolo",
+                "published_at": "2021-01-01 10:00:00",
+                "site_url": f"https://example.com/ep/{page * page_size + i}"
+            }
+            for i in range(page_size)
+        ]
+        for page in range(n_pages)
+    ]
+
+class TestAsyncSpreakerAPIClient:
+
+    def test_iter_show_episode_pages(self, stub_server):
+        stub_server.feed_pages = raw_feed_pages(3, 4)
+
+        async def collect():
+            async with AsyncSpreakerAPIClient("testtoken") as client:
+                return [page async for page in client.iter_show_episode_pages("42")]
+
+        assert asyncio.run(collect()) == stub_server.feed_pages
+
+    def test_get_episode_info_retries_rate_limit(self, stub_server):
+        stub_server.rate_limited = {"1"}
+
+        async def fetch():
+            async with AsyncSpreakerAPIClient("testtoken", max_in_flight=2) as client:
+                return await asyncio.gather(*(client.get_episode_info(str(i)) for i in range(4)))
+
+        infos = asyncio.run(fetch())
+        assert [info["response"]["episode"]["episode_id"] for info in infos] == ["0", "1", "2", "3"]
+        assert stub_server.requests["1"] == 2
+        assert stub_server.max_in_flight <= 2
+
+    def test_get_episode_info_retries_timeouts(self, stub_server):
+        stub_server.slow = {"1"}
+
+        async def fetch():
+            async with AsyncSpreakerAPIClient("testtoken", backoff_factor=0) as client:
+                return await client.get_episode_info("1")
+
+        with patch("support.async_apiclient.API_READ_TIMEOUT", 0.1):
+            info = asyncio.run(fetch())
+        assert info["response"]["episode"]["episode_id"] == "1"
+        assert stub_server.requests["1"] == 2
+
+    def test_get_gives_up_on_connection_errors(self):
+
+        async def fetch():
+            async with AsyncSpreakerAPIClient("testtoken", max_retries=2, backoff_factor=0) as client:
+                return await client.get("http://127.0.0.1:1/v2/episodes/1")
+
+        with pytest.raises(httpx.ConnectError):
+            asyncio.run(fetch())
+
+class TestAsyncIngestion:
+
+    def test_ingest_episodes(self, stub_server):
+        stub_server.feed_pages = raw_feed_pages(3, 5)
+        with patch("logic.logic.INGESTION_BATCH_SIZE", 4), tempfile.TemporaryDirectory() as tmpdirname:
+            Cacher.set_cache_folder(tmpdirname)
+            episode_handler = EpisodeHandler(SpreakerAPIClient("testtoken"), Show("42"), WordCounter())
+            episodes = asyncio.run(episode_handler.ingest_episodes())
+
+            assert list(episodes.keys()) == list(range(15))
+            assert set(episode_handler.show.episodes.keys()) == set(range(15))
+            # 15 episodes in batches of 4
+            assert episode_handler.show.generation == 4
+            assert len(episode_handler.topic_index) == 15
+            assert episodes[7].topics[0].label == "Topic 7"
+
+    def test_start_ingestion_in_background(self, stub_server):
+        stub_server.feed_pages = raw_feed_pages(3, 5)
+        stub_server.delay = 0.05
+        with patch("logic.logic.INGESTION_MODE", "async"), patch("logic.logic.INGESTION_BATCH_SIZE", 4), \
+                tempfile.TemporaryDirectory() as tmpdirname:
+            Cacher.set_cache_folder(tmpdirname)
+            episode_handler = EpisodeHandler(SpreakerAPIClient("testtoken"), Show("42"), WordCounter())
+            episode_handler.start_ingestion()
+
+            assert episode_handler.ingesting()
+            message, _ = episode_handler.search_text_in_episodes("topic", 3, 0)
+            assert message == TextRepo.MSG_EPISODES_LOADING
+            with patch.object(SpreakerAPIClient, "get_last_n_episode") as get_last_n_episode:
+                episode_handler.retrieve_new_episode()
+            get_last_n_episode.assert_not_called()
+
+            episode_handler.ingestion.join(10)
+            assert not episode_handler.ingesting()
+            assert set(episode_handler.show.episodes.keys()) == set(range(15))
+            assert len(episode_handler.topic_index) == 15
@@ -4,17 +4,26 @@ os.environ["PPB_ENV"] = "unittest"
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../src/')
 import pytest
-from logic.logic import SearchEngine, EpisodeHandler
+from logic.logic import SearchEngine, EpisodeHandler, TopicIndex, ShardedSearchPool
 from model.models import Episode, EpisodeTopic, Show
 from configuration_test import RAW_EP_FILEPATH, PROCD_EP_FILEPATH, SNIPPET_TXT_FILEPATH, THREE_RAW_EPS_FILEPATH, SRC_TEST_FOLDER
 from support.apiclient import SpreakerAPIClient
 from support.WordCounter import WordCounter
 from support.Cacher import Cacher
+from support.LRUCache import LRUCache
+from support.CallCounter import CallCounter, TimeSeries
+from support.SpaceSavingCounter import SpaceSavingCounter
+from support.PersistenceWorker import PersistenceWorker
+from threading import Event, Thread
+import random
+import time
 import json
 from unittest.mock import patch
 import tempfile
 import pathlib
 from collections import Counter
+import numpy as np
+from fuzzywuzzy import fuzz
 
 ############## fixtures ##############
 
@@ -52,6 +61,17 @@ def episode_procd():
 
     return episode
 
+@pytest.fixture
+def multi_word_episode():
+    episode = Episode('1', '1: Test', '2021-01-01 10:00:00', 'https://example.com/1', '')
+    labels = [
+        'Il signore degli anelli', 'Luca Celestepedone a Sanremo', 'Babbo Natale e le renne', 'Zerocalcare su Netflix',
+        'La pizza con ananas', 'Kenobit suona il Game Boy', 'Il ritorno del re', 'Festival di Sanremo 2021'
+    ]
+    episode.topics = [EpisodeTopic(label, f'https://example.com/{i}') for i, label in enumerate(labels)]
+
+    return episode
+
 @pytest.fixture
 def episode_handler(mock_client, mock_show):
     return EpisodeHandler(mock_client, mock_show, WordCounter())
@@ -90,6 +110,29 @@ def show_miss_two_eps_ids():
         yield Show('testtoken')
 
 
+############## oracles ##############
+
+def generate_sorted_topics(episodes, text):
+    """Every topic of every episode scored with fuzz.ratio and fully sorted, the reference the searches are checked
+    against."""
+    episodes_topic = list()
+    normalized_text = SearchEngine.normalize_query(text)
+    combs, n_words, technique = SearchEngine.query_combinations(normalized_text)
+
+    for ep in episodes.values():
+        for topic in ep.topics:
+            max_list = [max(fuzz.ratio(comb, word) for word in topic.tokens) for comb in combs]
+            episodes_topic.append((ep.episode_id, topic, int(sum(max_list) / n_words), technique, topic.url, max(max_list)))
+
+    max_score = max(episodes_topic, key=lambda x: x[2])[2]
+
+    return sorted(episodes_topic, key=lambda x: (-x[2], len(x[1].label))), normalized_text, max_score
+
+def filter_topics(sorted_topics, max_score, n, m):
+    """First n sorted topics having max score >= m and score >= 75% of the best score."""
+    return [tpl for tpl in sorted_topics if tpl[5] >= m and tpl[2] >= max_score * .75][:n]
+
+
 ############## SearchEngine ##############
 
 class TestSearchEngine:
@@ -153,13 +196,236 @@ class TestSearchEngine:
         episodes = {'42314321': episode_procd}
         text = 'babbo'
 
-        ls_eps, normalized_text, max_score = SearchEngine.generate_sorted_topics(episodes, text)
+        ls_eps, normalized_text, max_score = generate_sorted_topics(episodes, text)
 
         assert len(ls_eps) == len(episode_procd.topics)
         assert ls_eps[0][1].label == 'A Babbo Morto - Zerocalcare'
         assert max(ls_eps, key=lambda x: x[2])[2] == ls_eps[0][2]
         assert min(ls_eps, key=lambda x: x[2])[2] == ls_eps[-1][2]
 
+    def test_bounded_scoring_same_ranking(self, episode_procd, multi_word_episode):
+
+        for episodes in [{'42314321': episode_procd}, {'1': multi_word_episode}]:
+            for text in ['babbo', 'celestepedone', 'kenobit', 'zerocalcare', 'luca', 'twitch', 'luca celestepedone']:
+                with patch.object(SearchEngine, 'SCORING_MODE', 'combinations'):
+                    ls_eps_comb, _, max_score_comb = generate_sorted_topics(episodes, text)
+                with patch.object(SearchEngine, 'SCORING_MODE', 'bounded'):
+                    ls_eps_bound, _, max_score_bound = generate_sorted_topics(episodes, text)
+
+                assert max_score_comb == max_score_bound
+                assert [(tpl[1].label, tpl[2]) for tpl in ls_eps_comb] == [(tpl[1].label, tpl[2]) for tpl in ls_eps_bound]
+
+            # from three words on, every topic scores at most what it scores with combinations
+            for text in [
+                'a babbo morto zerocalcare', 'luca celestepedone su twitch', 'kenobit su twitch',
+                'luca celestepedone sanremo', 'sanremo festival celestepedone', 'netflix zerocalcare serie nuova'
+            ]:
+                with patch.object(SearchEngine, 'SCORING_MODE', 'combinations'):
+                    ls_eps_comb, _, max_score_comb = generate_sorted_topics(episodes, text)
+                with patch.object(SearchEngine, 'SCORING_MODE', 'bounded'):
+                    ls_eps_bound, _, max_score_bound = generate_sorted_topics(episodes, text)
+
+                scores_comb = {id(tpl[1]): (tpl[2], tpl[5]) for tpl in ls_eps_comb}
+                assert max_score_bound <= max_score_comb
+                for tpl in ls_eps_bound:
+                    assert tpl[2] <= scores_comb[id(tpl[1])][0]
+                    assert tpl[5] <= scores_comb[id(tpl[1])][1]
+
+        for w in {"uccell", "uccellino", "uccelletto", "uccullo"}:
+            assert SearchEngine.compare_strings("uccello", w)[0] == SearchEngine.compare_tokens(
+                ["uccello"], SearchEngine.query_combinations(w, "combinations")
+            )[0]
+
+    def test_multi_word_ranking(self, multi_word_episode):
+
+        episodes = {'1': multi_word_episode}
+        expected = {
+            'signore degli anelli': ['Il signore degli anelli'],
+            'luca celestepedone sanremo': ['Luca Celestepedone a Sanremo'],
+            'kenobit game boy': ['Kenobit suona il Game Boy'],
+            'pizza ananas fritta': ['La pizza con ananas'],
+            'sanremo festival celestepedone': ['Luca Celestepedone a Sanremo', 'Festival di Sanremo 2021'],
+            'netflix zerocalcare serie nuova': ['Zerocalcare su Netflix'],
+        }
+
+        assert SearchEngine.SCORING_MODE == 'combinations'
+        for text, labels in expected.items():
+            top, _, _ = SearchEngine.generate_top_topics(episodes, text, 3, 0)
+            assert [tpl[1].label for tpl in top] == labels
+
+            # bounded scores three or more words lower, the best topic has to stay the same
+            with patch.object(SearchEngine, 'SCORING_MODE', 'bounded'):
+                top_bound, _, _ = SearchEngine.generate_top_topics(episodes, text, 3, 0)
+            assert top_bound[0][1].label == labels[0]
+            assert top_bound[0][2] <= top[0][2]
+
+    def test_typo_queries_same_results_as_full_scan(self, multi_word_episode):
+
+        episodes = {'1': multi_word_episode}
+        topic_index = TopicIndex()
+        topic_index.add_episodes(episodes)
+
+        for text in ['babob ulca', 'luac netflxi', 'ipzza gmae', 'edgli naelli', 'suoan netlfix', 'nteflix keonbit']:
+            ls_eps, _, max_score = generate_sorted_topics(episodes, text)
+            top, _, max_score_idx = SearchEngine.generate_top_topics(episodes, text, 3, 0, topic_index)
+
+            assert max_score_idx == max_score
+            assert [(tpl[1].label, tpl[2]) for tpl in top] == [(tpl[1].label, tpl[2]) for tpl in filter_topics(ls_eps, max_score, 3, 0)]
+
+        # the shortlist misses 'Zerocalcare su Netflix', it shares no trigram with the query
+        top, _, _ = SearchEngine.generate_top_topics(episodes, 'edgli naelli', 3, 0, topic_index, True)
+        assert [tpl[1].label for tpl in top] == ['Il signore degli anelli']
+
+    def test_query_combinations_bounded(self):
+
+        text = "uno due tre quattro cinque sei sette otto nove dieci undici dodici"
+
+        combs_bound, n_words_bound, _ = SearchEngine.query_combinations(text, "bounded")
+        combs_all, n_words_all, _ = SearchEngine.query_combinations(text, "combinations")
+
+        assert len(combs_all) == 2 ** 12 - 1
+        assert n_words_all == 12
+        assert n_words_bound == SearchEngine.MAX_QUERY_WORDS
+        assert len(combs_bound) <= SearchEngine.MAX_QUERY_WORDS * SearchEngine.MAX_NGRAM_SIZE
+        assert "unodue" in combs_bound and "unotre" not in combs_bound
+
+        with pytest.raises(ValueError):
+            SearchEngine.query_combinations(text, "nope")
+
+    def test_generate_top_topics(self, episode_procd):
+
+        episodes = {'42314321': episode_procd}
+        topic_index = TopicIndex()
+        topic_index.add_episodes(episodes)
+
+        for text in ['babbo', 'celestepedone', 'luca celestepedone', 'kenobit']:
+            ls_eps, _, max_score = generate_sorted_topics(episodes, text)
+
+            for n, m in [(3, 70), (10, 70), (10, 0), (1, 100)]:
+                expected = [(tpl[1].label, tpl[2]) for tpl in filter_topics(ls_eps, max_score, n, m)]
+
+                top_loop, _, max_score_loop = SearchEngine.generate_top_topics(episodes, text, n, m)
+                top_batch, _, max_score_batch = SearchEngine.generate_top_topics(
+                    episodes, text, n, m, topic_index, shortlist=False
+                )
+
+                assert max_score_loop == max_score_batch == max_score
+                assert [(tpl[1].label, tpl[2]) for tpl in top_loop] == expected
+                assert [(tpl[1].label, tpl[2]) for tpl in top_batch] == expected
+
+    def test_shortlist_falls_back_to_full_scan(self):
+
+        episode = Episode('1', '1: Test', '2021-01-01 10:00:00', 'https://example.com/1', '')
+        # the typo shares no trigram with the query, yet it is the closest topic
+        episode.topics = [EpisodeTopic('Celentano', 'https://example.com/a'), EpisodeTopic('Lceeseptendoe', 'https://example.com/b')]
+        episodes = {'1': episode}
+        topic_index = TopicIndex()
+        topic_index.add_episodes(episodes)
+        assert topic_index.candidates('celestepedone').tolist() == [0]
+
+        top, _, max_score = SearchEngine.generate_top_topics(episodes, 'celestepedone', 5, 0, topic_index, True)
+        assert max_score == 77
+        assert [tpl[1].label for tpl in top] == ['Lceeseptendoe']
+
+        with patch.object(SearchEngine, 'SHORTLIST_MIN_SCORE', 0):
+            top, _, max_score = SearchEngine.generate_top_topics(episodes, 'celestepedone', 5, 0, topic_index, True)
+            assert max_score == 55
+            assert [tpl[1].label for tpl in top] == ['Celentano']
+
+            # without the shortlist, the default, every topic is scored whatever the best score
+            top, _, max_score = SearchEngine.generate_top_topics(episodes, 'celestepedone', 5, 0, topic_index)
+            assert max_score == 77
+            assert [tpl[1].label for tpl in top] == ['Lceeseptendoe']
+
+    def test_sharded_search_pool(self, episode_procd):
+
+        episodes = {'42314321': episode_procd}
+        topic_index = TopicIndex()
+        topic_index.add_episodes(episodes)
+
+        search_pool = ShardedSearchPool(2)
+        search_pool.sync(topic_index)
+
+        try:
+            for text in ['babbo', 'celestepedone', 'luca celestepedone', 'kenobit']:
+                top_serial, _, max_score_serial = SearchEngine.generate_top_topics(episodes, text, 3, 70, topic_index)
+                top_pool, _, max_score_pool = search_pool.generate_top_topics(
+                    topic_index, SearchEngine.normalize_query(text), 3, 70
+                )
+
+                assert max_score_serial == max_score_pool
+                assert [(tpl[1].label, tpl[2]) for tpl in top_serial] == [(tpl[1].label, tpl[2]) for tpl in top_pool]
+        finally:
+            search_pool.shutdown()
+
+    def test_sharded_search_pool_sync_during_search(self, multi_word_episode):
+
+        topic_index = TopicIndex()
+        topic_index.add_episodes({'1': multi_word_episode})
+        search_pool = ShardedSearchPool(1)
+        search_pool.sync(topic_index)
+
+        try:
+            # a search holding the only shard while sync replaces it
+            executors = search_pool._acquire()
+            second = Episode('2', '2: Secondo', '2021-01-08 10:00:00', 'https://example.com/2', '')
+            second.topics = [EpisodeTopic('Pizza margherita', 'https://example.com/p')]
+            topic_index.add_episodes({'2': second})
+            assert not search_pool.covers(topic_index)
+            search_pool.sync(topic_index)
+            assert search_pool.covers(topic_index)
+
+            assert executors[0].submit(len, 'ok').result() == 2
+            search_pool._release(executors)
+            with pytest.raises(RuntimeError):
+                executors[0].submit(len, 'ok')
+
+            top, _, _ = search_pool.generate_top_topics(topic_index, SearchEngine.normalize_query('pizza margherita'), 1, 0)
+            assert top[0][1].label == 'Pizza margherita'
+            assert search_pool._in_flight == {}
+        finally:
+            search_pool.shutdown()
+
+    def test_generate_top_topics_with_index(self, episode_procd):
+
+        episodes = {'42314321': episode_procd}
+        topic_index = TopicIndex()
+        topic_index.add_episodes(episodes)
+
+        assert not SearchEngine.SHORTLIST
+        for text in ['babbo', 'zerocalcare', 'celestepedone', 'luca', 'kenobit', 'twitch', 'a babbo morto', 'babo mrto']:
+            ls_eps, _, max_score = generate_sorted_topics(episodes, text)
+            top_idx, _, max_score_idx = SearchEngine.generate_top_topics(episodes, text, 5, 70, topic_index)
+
+            assert max_score_idx == max_score
+            assert [tpl[1].label for tpl in top_idx] == [tpl[1].label for tpl in filter_topics(ls_eps, max_score, 5, 70)]
+
+    def test_topic_index_add_episodes_incrementally(self, episode_procd):
+
+        topic_index = TopicIndex()
+        topic_index.add_episodes({'42314321': episode_procd})
+        topic_index.add_episodes({'42314321': episode_procd})
+
+        assert len(topic_index) == len(episode_procd.topics)
+        assert all(topic_index.topic(position)[0] == episode_procd.episode_id for position in topic_index.candidates('babbo'))
+
+    def test_batch_score(self, episode_procd):
+
+        episodes = {'42314321': episode_procd}
+        topic_index = TopicIndex()
+        topic_index.add_episodes(episodes)
+
+        for text in ['babbo', 'celestepedone', 'luca celestepedone', 'twich kenobit su', 'zerocalcare babbo morto']:
+            ls_eps, _, _ = generate_sorted_topics(episodes, text)
+            query = SearchEngine.query_combinations(SearchEngine.normalize_query(text))
+            match_scores, max_scores = SearchEngine.batch_score(topic_index, query, np.arange(len(topic_index)))
+
+            expected = {tpl[1].label: (tpl[2], tpl[5]) for tpl in ls_eps}
+            assert {
+                topic_index.topic(position)[1].label: (match_score, max_score)
+                for position, match_score, max_score in zip(range(len(topic_index)), match_scores.tolist(), max_scores.tolist())
+            } == expected
+
 ############## EpisodeHandler ##############
 
 class TestEpisodeHandler:
@@ -211,7 +477,7 @@ class TestEpisodeHandler:
         episodes = {'42314321': episode_procd}
         text = 'babbo'
 
-        ls_eps, normalized_text, max_score = SearchEngine.generate_sorted_topics(episodes, text)
+        ls_eps, normalized_text, max_score = generate_sorted_topics(episodes, text)
 
         filter_episodes = [tpl for tpl in ls_eps if tpl[2] > int(max_score * .75)]
 
@@ -225,6 +491,39 @@ class TestEpisodeHandler:
 
         assert msg.replace('\n', '').strip() == exp_msg.strip()
 
+    def test_format_single_episode_memoized(self, episode_procd, episode_handler):
+
+        msg = episode_handler.format_single_episode(episode_procd)
+        assert episode_handler.format_single_episode(episode_procd) is msg
+
+        episode_procd.title_str = " Un altro titolo"
+        msg_changed = episode_handler.format_single_episode(episode_procd)
+        assert msg_changed != msg
+        assert "Un altro titolo" in msg_changed
+
+    def test_get_host_map_refreshed_on_new_episodes(self, mock_client):
+
+        show = Show('test_id')
+        episode_handler = EpisodeHandler(mock_client, show, WordCounter())
+        first = Episode('1', '1: Primo', '2021-01-01 10:00:00', 'url1', 'Con: Sio, Lorro')
+        episode_handler.show.set_episodes = {first.episode_id: first}
+        episode_handler.index_episodes({first.episode_id: first})
+
+        msg = episode_handler.get_host_map("abc")
+        assert episode_handler.get_host_map("abc") is msg
+        assert msg == episode_handler.render_host_map("abc")
+        assert episode_handler.get_host_map("unknown") == episode_handler.render_host_map("frequency")
+
+        second = Episode('2', '2: Secondo', '2021-01-08 10:00:00', 'url2', 'Con: Sio, Nick')
+        episode_handler.show.set_episodes = {second.episode_id: second}
+        assert episode_handler.get_host_map("abc") is msg
+        episode_handler.index_episodes({second.episode_id: second})
+
+        msg_after = episode_handler.get_host_map("abc")
+        assert "Nick presente in 1 episodio (2)" in msg_after
+        assert "Sio presente in 2 episodi (2, 1)" in msg_after
+        assert msg_after == episode_handler.render_host_map("abc")
+
     def test_retrieve_new_episodes_all(self, client_get_last_eps, show_all_eps_ids):
 
         with tempfile.TemporaryDirectory() as tmpdirname:
@@ -270,6 +569,122 @@ class TestEpisodeHandler:
 
             assert n_episodes_after - n_episodes_before == 2
 
+    def test_retrieve_new_episodes_not_modified(self, show_miss_two_eps_ids):
+
+        with patch.object(SpreakerAPIClient, 'get_last_n_episode', return_value=None), \
+                tempfile.TemporaryDirectory() as tmpdirname:
+
+            Cacher.set_cache_folder(tmpdirname)
+            episode_handler = EpisodeHandler(SpreakerAPIClient('testtoken'), show_miss_two_eps_ids, WordCounter())
+            generation_before = episode_handler.show.generation
+
+            episode_handler.retrieve_new_episode()
+
+            assert episode_handler.show.generation == generation_before
+
+    def test_search_query_cache(self, mock_client, episode_procd):
+
+        show = Show('test_id')
+        show.set_episodes = {episode_procd.episode_id: episode_procd}
+        episode_handler = EpisodeHandler(mock_client, show, WordCounter())
+        episode_handler.topic_index.add_episodes(show.episodes)
+
+        msg, _ = episode_handler.search_text_in_episodes('babbo', 3, 70)
+        msg_again, _ = episode_handler.search_text_in_episodes('Babbo!', 3, 70)
+
+        assert msg == msg_again
+        assert episode_handler.query_cache.stats()['hits'] == 1
+        assert episode_handler.query_cache.stats()['misses'] == 1
+
+        # episodes added but not indexed yet, the cached result is still the current one
+        show.set_episodes = {}
+        episode_handler.search_text_in_episodes('babbo', 3, 70)
+        assert episode_handler.query_cache.stats()['misses'] == 1
+
+        episode_handler.index_episodes({})
+        episode_handler.search_text_in_episodes('babbo', 3, 70)
+
+        assert episode_handler.query_cache.stats()['misses'] == 2
+
+    def test_lru_cache_eviction(self):
+
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+    def test_cache_db_roundtrip(self, episode_procd):
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+
+            Cacher.set_cache_folder(tmpdirname)
+            Cacher.export_json({episode_procd.episode_id: episode_procd})
+
+            imported = Cacher.import_json()
+            loaded = Cacher.load_db()
+
+            assert list(loaded.keys()) == list(imported.keys()) == [episode_procd.episode_id]
+
+            episode = loaded[episode_procd.episode_id]
+            assert episode.title == episode_procd.title
+            assert episode.description_raw == episode_procd.description_raw
+            assert episode.number == episode_procd.number
+            assert episode.sub_number == episode_procd.sub_number
+            assert episode.hosts == episode_procd.hosts
+            assert [t.tokens for t in episode.topics] == [t.tokens for t in episode_procd.topics]
+
+    def test_cache_journal(self, episode_procd):
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+
+            Cacher.set_cache_folder(tmpdirname)
+            Cacher.export_json({})
+
+            with patch.object(Cacher, 'CACHE_FORMAT', 'json'), patch.object(Cacher, 'CACHE_JOURNAL_COMPACT_EVERY', 2):
+                Cacher.cache_updater({episode_procd.episode_id: episode_procd})
+
+                assert os.path.exists(Cacher.journal_filepath())
+                assert list(Cacher.load_json().keys()) == [episode_procd.episode_id]
+
+                with open(Cacher.journal_filepath(), 'a') as f:
+                    f.write('{"episode_id": "cut sho')
+
+                episode_procd.episode_id = 'another_id'
+                Cacher.cache_updater({episode_procd.episode_id: episode_procd})
+
+                assert not os.path.exists(Cacher.journal_filepath())
+                assert len(Cacher.load_json()) == 2
+
+    def test_cache_journal_entries_kept_in_memory(self, multi_word_episode):
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+
+            Cacher.set_cache_folder(tmpdirname)
+            Cacher.export_json({})
+
+            with patch.object(Cacher, 'CACHE_FORMAT', 'json'), patch.object(Cacher, 'CACHE_JOURNAL_COMPACT_EVERY', 3), \
+                    patch.object(Cacher, 'read_journal', wraps=Cacher.read_journal) as read_journal:
+                for episode_id in ['1', '2']:
+                    multi_word_episode.episode_id = episode_id
+                    Cacher.cache_updater({episode_id: multi_word_episode})
+                assert Cacher._journal_entries == 2
+                assert os.path.exists(Cacher.journal_filepath())
+
+                multi_word_episode.episode_id = '3'
+                Cacher.cache_updater({'3': multi_word_episode})
+                # only compacting reads the journal
+                read_journal.assert_called_once_with(None)
+
+            assert Cacher._journal_entries == 0
+            assert not os.path.exists(Cacher.journal_filepath())
+            assert list(Cacher.load_json().keys()) == ['1', '2', '3']
+
     def test_word_counter_save(self):
         
         TEST_COUNTER_FILEPATH = os.path.join(SRC_TEST_FOLDER, 'resources', 'word_count_test.json')
@@ -296,3 +711,210 @@ class TestEpisodeHandler:
 
         with open(TEST_COUNTER_FILEPATH, 'w') as f:
             json.dump({}, f)
+
+############## CallCounter ##############
+
+class TestCallCounter:
+
+    def test_time_series_sum_between(self):
+        series = TimeSeries()
+        for timestamp, count in [(10, 1), (20, 2), (20, 3), (40, 4), (30, 5), (5, 6)]:
+            series.add(timestamp, count)
+
+        assert series.items() == [(5, 6), (10, 1), (20, 5), (30, 5), (40, 4)]
+        assert series.sum_between(0, 100) == 21
+        assert series.sum_between(10, 30) == 11
+        assert series.sum_between(11, 19) == 0
+        assert series.sum_between(40, 40) == 4
+
+    def test_daily_counts_and_log(self):
+        day = 86400
+        hour = 3600
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            legacy_filepath = os.path.join(tmpdirname, 'call_count.json')
+            filepath = os.path.join(tmpdirname, 'call_count.log')
+            legacy = {str(day * 100 + hour * 2): 3, str(day * 100 + hour * 20): 4, str(day * 102 + hour * 5): 5}
+            with open(legacy_filepath, 'w') as f:
+                json.dump(legacy, f)
+
+            with patch.object(CallCounter, 'CALL_COUNTER_FILEPATH', filepath), \
+                    patch.object(CallCounter, 'LEGACY_CALL_COUNTER_FILEPATH', legacy_filepath), \
+                    patch.object(CallCounter, 'instance', None):
+                call_counter = CallCounter()
+                assert not os.path.exists(legacy_filepath)
+                assert os.path.exists(f'{legacy_filepath}.migrated')
+
+                assert call_counter.daily_counts(day * 100, day * 103 - 1) == [(day * 100, 7), (day * 102, 5)]
+                # the first day only from 10:00
+                assert call_counter.daily_counts(day * 100 + hour * 10, day * 103 - 1) == [(day * 100, 4), (day * 102, 5)]
+
+                call_counter.add_call()
+                call_counter.dump_data()
+                call_counter.add_call()
+                call_counter.dump_data()
+
+                CallCounter.instance = None
+                reloaded = CallCounter()
+                assert reloaded.hours.items() == call_counter.hours.items()
+                assert reloaded.count_between(0, 2 ** 40) == 14
+
+                # converted only once, a JSON put back by hand is not read again
+                with open(legacy_filepath, 'w') as f:
+                    json.dump(legacy, f)
+                CallCounter.instance = None
+                assert CallCounter().count_between(0, 2 ** 40) == 14
+
+############## WordCounter ##############
+
+class TestSpaceSavingCounter:
+
+    def test_space_saving_guarantees(self):
+        rnd = random.Random(3)
+        stream = [f"q{int(rnd.paretovariate(1.1))}" for _ in range(20000)]
+        exact = Counter(stream)
+        sketch = SpaceSavingCounter(50)
+        for item in stream:
+            sketch.add(item)
+
+        assert len(sketch) == 50
+        assert sketch.total == len(stream)
+        assert sketch.min_count == min(sketch.counts.values())
+        for item, count in sketch.counts.items():
+            assert count - sketch.errors[item] <= exact[item] <= count
+            assert sketch.errors[item] <= sketch.error_bound()
+        for item, count in exact.items():
+            if count > sketch.error_bound():
+                assert item in sketch
+        assert [item for item, count in sketch.most_common(3)] == [item for item, count in exact.most_common(3)]
+
+        restored = SpaceSavingCounter.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        assert restored.counts == sketch.counts
+        assert restored.errors == sketch.errors
+        assert restored.min_count == sketch.min_count
+
+        shrunk = SpaceSavingCounter.from_dict(sketch.to_dict(), 10)
+        assert shrunk.capacity == 10
+        assert shrunk.counts == dict(sketch.most_common(10))
+        assert shrunk.total == sketch.total
+        assert shrunk.min_count == min(shrunk.counts.values())
+
+        grown = SpaceSavingCounter.from_dict(sketch.to_dict(), 100)
+        assert grown.capacity == 100
+        assert grown.counts == sketch.counts
+        grown.add('new')
+        assert len(grown) == 51
+
+    def test_word_counter_space_saving_mode(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            filepath = os.path.join(tmpdirname, 'word_count.json')
+            with open(filepath, 'w') as f:
+                json.dump({'salve': 3, 'ciao': 2, 'arrivederci': 1}, f)
+            # patched so the next tests don't find the counter in a deleted folder
+            with patch.object(WordCounter, 'WORD_COUNTER_FILEPATH', filepath), patch.object(WordCounter, 'instance', None):
+                word_counter = WordCounter(mode="space_saving", capacity=2)
+                assert word_counter.most_common(2) == [('salve', 3), ('ciao', 2)]
+                word_counter.add_word('buongiorno')
+                assert word_counter.most_common(1) == [('salve', 3)]
+                assert word_counter.dump_counter() == 1
+
+                WordCounter.instance = None
+                reloaded = WordCounter(mode="space_saving", capacity=2)
+                assert reloaded.counter.counts == {'salve': 3, 'buongiorno': 3}
+                assert reloaded.counter.total == 7
+
+                # the configured capacity wins over the saved one
+                WordCounter.instance = None
+                reloaded = WordCounter(mode="space_saving", capacity=1)
+                assert reloaded.counter.capacity == 1
+                assert len(reloaded.counter) == 1
+
+############## PersistenceWorker ##############
+
+class TestPersistenceWorker:
+
+    def test_requests_coalesce_and_skip(self):
+        writing = Event()
+        release = Event()
+        snapshots = []
+
+        def snapshot(force):
+            snapshots.append(force)
+            if len(snapshots) == 3 and not force:
+                return None
+
+            def write():
+                writing.set()
+                release.wait(5)
+                return 10
+            return write
+
+        worker = PersistenceWorker()
+        worker.register("store", snapshot)
+        worker.start()
+        worker.request("store")
+        assert writing.wait(5)
+        # the worker is stuck writing, these pile up into a single dump
+        for _ in range(5):
+            worker.request("store")
+        release.set()
+        worker.request("store")
+        worker.stop()
+        assert len(snapshots) <= 3
+
+        assert worker.flush() == {"store": 1}
+        stats = worker.stats()["store"]
+        assert stats["dumps"] + stats["skipped"] == len(snapshots)
+        assert stats["total_bytes"] == 10 * stats["dumps"]
+        assert stats["errors"] == 0
+
+    def test_stop_writes_pending_requests(self):
+        writing = Event()
+        release = Event()
+        written = []
+
+        def snapshot(name):
+            def store_snapshot(force):
+                def write():
+                    if name == "slow":
+                        writing.set()
+                        release.wait(5)
+                    written.append((name, force))
+                    return 1
+                return write
+            return store_snapshot
+
+        worker = PersistenceWorker()
+        worker.register("slow", snapshot("slow"))
+        worker.register("other", snapshot("other"))
+        worker.start()
+        worker.request("slow")
+        assert writing.wait(5)
+        # asked while the worker is busy, still waiting when the bot stops
+        worker.request("other", force=True)
+        stopper = Thread(target=worker.stop)
+        stopper.start()
+        while worker.running:
+            time.sleep(0.01)
+        release.set()
+        stopper.join(5)
+
+        assert sorted(written) == [("other", True), ("slow", False)]
+        assert worker.pending == {}
+
+    def test_word_counter_snapshot_only_when_dirty(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            filepath = os.path.join(tmpdirname, 'word_count.json')
+            with open(filepath, 'w') as f:
+                json.dump({'salve': 3}, f)
+            with patch.object(WordCounter, 'WORD_COUNTER_FILEPATH', filepath), patch.object(WordCounter, 'instance', None):
+                word_counter = WordCounter(mode="exact")
+
+                assert word_counter.snapshot_for_dump() is None
+                word_counter.add_word('ciao')
+                write = word_counter.snapshot_for_dump()
+                # words counted after the snapshot wait for the next dump
+                word_counter.add_word('ciao')
+                assert write() > 0
+                with open(filepath) as f:
+                    assert json.load(f) == {'salve': 3, 'ciao': 1}
+                assert word_counter.snapshot_for_dump() is not None
@@ -5,11 +5,14 @@ from typing import Dict
 os.environ["PPB_ENV"] = "unittest"
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../src/')
-from model.models import SearchConfigs, UserConfig, Episode, EpisodeTopic
+from model.models import SearchConfigs, UserConfig, Episode, EpisodeTopic, Utils, Show
 from configuration_test import PROCD_EP_FILEPATH, SRC_TEST_FOLDER
 import pytest
 import json
 from hashlib import sha1
+from support.decorators import chat_id_digest, legacy_chat_id_digest
+import tempfile
+from unittest.mock import patch
 
 
 ############## fixtures ##############
@@ -85,6 +88,22 @@ def test_from_dict(episode_procd):
     assert episode_procd.site_url == ep_from_dict.site_url
     assert episode_procd.description_raw == ep_from_dict.description_raw
 
+    for topic_from_dict, topic_ep in zip(ep_from_dict.topics, episode_procd.topics):
+        assert topic_from_dict.normalized_label == topic_ep.normalized_label
+        assert topic_from_dict.tokens == topic_ep.tokens
+
+
+def test_episode_topic_normalized_label():
+    topic = EpisodeTopic("A Babbo Morto - Zerocalcare", "https://www.storytel.com")
+
+    assert topic.normalized_label == "babbo morto zerocalcare"
+    assert topic.tokens == ["babbo", "morto", "zerocalcare"]
+
+    topic_from_dict = EpisodeTopic.from_dict({"label": topic.label, "url": topic.url})
+
+    assert topic_from_dict.normalized_label == topic.normalized_label
+    assert topic_from_dict.tokens == topic.tokens
+
 
 def test_populate_topic(episode_procd):
     episode_procd.topics = list()
@@ -152,6 +171,40 @@ def test_chek_if_same_value():
         SearchConfigs.check_if_same_value(1, 5, 'w')
 
 
+def test_default_user_cfg_not_stored():
+    assert SearchConfigs.get_user_show_first_n(42) == SearchConfigs.DEFAULT_N
+    assert SearchConfigs.get_user_cfg(42).m == SearchConfigs.DEFAULT_M
+    assert chat_id_digest(42).hex() not in SearchConfigs.normalize_user_data()
+    assert SearchConfigs.get_users_total_n() == 4
+
+    SearchConfigs.set_user_cfg(42, 7, 'n')
+    assert SearchConfigs.get_user_cfg(42).n == 7
+    assert SearchConfigs.get_users_total_n() == 4
+
+
+def test_seen_users_survive_restart():
+    for chat_id in range(100, 110):
+        SearchConfigs.get_user_cfg(chat_id)
+    assert SearchConfigs.get_users_total_n() == 13
+    SearchConfigs.dump_data()
+
+    with open(SearchConfigs.USERS_CFG_FILEPATH, 'r') as f:
+        data = json.load(f)
+    # the defaults are only listed as seen, older dumps stored them as configs
+    assert chat_id_digest(100).hex() not in data
+    assert chat_id_digest(100).hex() in data[SearchConfigs.SEEN_USERS_KEY]
+    assert chat_id_digest(2).hex() not in data[SearchConfigs.SEEN_USERS_KEY]
+    data[chat_id_digest(200).hex()] = {'n': SearchConfigs.DEFAULT_N, 'm': SearchConfigs.DEFAULT_M}
+    with open(SearchConfigs.get_newest_backup(), 'w') as f:
+        json.dump(data, f)
+
+    SearchConfigs.reset_user_data()
+    SearchConfigs.init_data()
+    assert SearchConfigs.get_users_total_n() == 14
+    assert chat_id_digest(200).hex() not in SearchConfigs.normalize_user_data()
+    assert SearchConfigs.get_user_show_first_n(2) == 10
+
+
 def test_set_user_cfg():
     SearchConfigs.set_user_cfg(1, 999, 'n')
     SearchConfigs.set_user_cfg(1, 99, 'm')
@@ -166,9 +219,9 @@ def test_set_user_cfg():
 def test_normalize_user_data():
     data = SearchConfigs.normalize_user_data()
 
-    one_hashed = sha1(bytes(1)).hexdigest()
-    two_hashed = sha1(bytes(2)).hexdigest()
-    three_hashed = sha1(bytes(3)).hexdigest()
+    one_hashed = chat_id_digest(1).hex()
+    two_hashed = chat_id_digest(2).hex()
+    three_hashed = chat_id_digest(3).hex()
 
     assert data[one_hashed]['n'] == SearchConfigs.get_user_show_first_n(1)
     assert data[one_hashed]['m'] == SearchConfigs.get_user_show_min_threshold(1)
@@ -180,10 +233,69 @@ def test_normalize_user_data():
     assert data[three_hashed]['m'] == SearchConfigs.get_user_show_min_threshold(3)
 
 
-def test_dump_data():
-    one_hashed = sha1(bytes(1)).hexdigest()
-    two_hashed = sha1(bytes(2)).hexdigest()
+def test_chat_id_digest():
+    assert chat_id_digest(123456789) == chat_id_digest(123456789)
+    assert chat_id_digest(123456789) != chat_id_digest(-123456789)
+    assert len(chat_id_digest(-1001234567890)) == 16
+
+    assert legacy_chat_id_digest(3) == sha1(bytes(3)).digest()
+    assert legacy_chat_id_digest(-(1 << 20) - 7) == sha1(bytes((1 << 20) + 7)).digest()
+    with patch('support.decorators.LEGACY_CHAT_ID_HASH_MAX_BYTES', 1000):
+        assert legacy_chat_id_digest(1001) is None
+
+
+def test_legacy_key_migration():
+    dump_folder = SearchConfigs.DUMP_FOLDER
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        SearchConfigs.DUMP_FOLDER = tmpdirname
+        with open(os.path.join(tmpdirname, 'backup20220101T000000.json'), 'w') as f:
+            json.dump({
+                sha1(bytes(123456789)).hexdigest(): {'n': 12, 'm': 34},
+                sha1(bytes(9)).hexdigest(): {'n': 8, 'm': 80},
+                sha1(bytes(5000)).hexdigest(): {'n': 7, 'm': 70}
+            }, f)
+        # chat 9 changed its config after the migration of the run that crashed
+        with open(SearchConfigs.journal_filepath(), 'w') as f:
+            f.write(json.dumps({'chat_id': chat_id_digest(9).hex(), 'field': 'n', 'value': 6}) + '\n')
+        SearchConfigs.reset_user_data()
+        SearchConfigs.init_data()
+
+        # nothing is dropped at boot, chats that don't show up keep their legacy key in the snapshots
+        SearchConfigs.dump_data()
+        with open(SearchConfigs.USERS_CFG_FILEPATH, 'r') as f:
+            data = json.load(f)
+        assert data[sha1(bytes(123456789)).hexdigest()] == {'n': 12, 'm': 34}
+        assert data[sha1(bytes(5000)).hexdigest()] == {'n': 7, 'm': 70}
+        SearchConfigs.reset_user_data()
+        SearchConfigs.init_data()
+
+        assert SearchConfigs.get_user_show_first_n(8) == 5
+        assert SearchConfigs.get_user_show_first_n(123456789) == 12
+        assert SearchConfigs.get_user_show_min_threshold(123456789) == 34
+        assert SearchConfigs.get_user_show_first_n(9) == 6
+        assert SearchConfigs.normalize_user_data() == {
+            chat_id_digest(123456789).hex(): {'n': 12, 'm': 34},
+            chat_id_digest(9).hex(): {'n': 6, 'm': 1},
+            sha1(bytes(5000)).hexdigest(): {'n': 7, 'm': 70}
+        }
+        assert SearchConfigs.get_users_total_n() == 4
+
+        # the move is journaled, a restart from the same backup already has the new key
+        SearchConfigs.reset_user_data()
+        SearchConfigs.init_data()
+        assert chat_id_digest(123456789) in SearchConfigs._user_data
+        assert SearchConfigs.get_user_show_min_threshold(123456789) == 34
+
+        SearchConfigs.dump_data()
+        with open(SearchConfigs.USERS_CFG_FILEPATH, 'r') as f:
+            data = json.load(f)
+        assert sha1(bytes(123456789)).hexdigest() not in data
+        assert data[chat_id_digest(123456789).hex()] == {'n': 12, 'm': 34}
+        assert data[sha1(bytes(5000)).hexdigest()] == {'n': 7, 'm': 70}
+    SearchConfigs.DUMP_FOLDER = dump_folder
+
 
+def test_dump_data():
     SearchConfigs.dump_data()
 
     SearchConfigs.set_user_cfg(1, 10, 'n')
@@ -204,13 +316,38 @@ def test_dump_data():
     assert SearchConfigs.get_user_show_first_n(2) == 111
     assert SearchConfigs.get_user_show_min_threshold(2) == 112
 
+    # changes after the last dump are in the journal, so they survive a restart
+    SearchConfigs.reset_user_data()
     SearchConfigs.init_data()
 
-    assert SearchConfigs.get_user_show_first_n(1) == 10
-    assert SearchConfigs.get_user_show_min_threshold(1) == 20
+    assert SearchConfigs.get_user_show_first_n(1) == 999
+    assert SearchConfigs.get_user_show_min_threshold(1) == 998
+
+    assert SearchConfigs.get_user_show_first_n(2) == 111
+    assert SearchConfigs.get_user_show_min_threshold(2) == 112
+
+    with open(SearchConfigs.USERS_CFG_FILEPATH, 'r') as f:
+        assert json.load(f)[chat_id_digest(1).hex()] == {'n': 10, 'm': 20}
 
-    assert SearchConfigs.get_user_show_first_n(2) == 30
-    assert SearchConfigs.get_user_show_min_threshold(2) == 40
+
+def test_dump_data_truncates_journal():
+    SearchConfigs.dump_data()
+    assert not os.path.exists(SearchConfigs.journal_filepath())
+    assert SearchConfigs.list_compacting_journals() == []
+
+    SearchConfigs.set_user_cfg(3, 7, 'n')
+    # a compaction interrupted by a crash leaves its journal aside, it is replayed before the live one
+    with open(SearchConfigs.journal_filepath() + '.20000101T000000.compacting', 'w') as f:
+        f.write(json.dumps({'chat_id': chat_id_digest(3).hex(), 'field': 'n', 'value': 6}) + '\n{"chat_id": "tr')
+
+    SearchConfigs.reset_user_data()
+    SearchConfigs.init_data()
+    assert SearchConfigs.get_user_show_first_n(3) == 7
+    assert SearchConfigs.get_user_show_min_threshold(3) == 90
+
+    SearchConfigs.dump_data()
+    assert SearchConfigs.list_compacting_journals() == []
+    assert [f for f in os.listdir(SearchConfigs.DUMP_FOLDER) if 'journal' in f] == []
 
 
 def create_episode_given_title(title: str) -> Episode:
@@ -243,3 +380,64 @@ def test_episode():
     episode = create_episode_given_title('199c201:fdsfsd 201')
     assert 199 == episode.number
     assert '' == episode.sub_number
+
+
+def test_episode_memoized():
+    episode = create_episode_given_title('199: fdsdfs')
+    calls = []
+
+    def render():
+        calls.append(1)
+        return f"{episode.number}{episode.sub_number}"
+
+    assert episode.memoized('key', render) == '199'
+    assert episode.memoized('key', render) == '199'
+    assert len(calls) == 1
+
+    # unrelated fields keep the cache, render fields drop it
+    episode.topics = []
+    assert episode.memoized('key', render) == '199'
+    assert len(calls) == 1
+    episode.number = -2
+    assert episode.memoized('key', render) == '-2'
+    assert len(calls) == 2
+
+    restored = Episode.from_record(episode.to_record())
+    assert restored.memoized('key', lambda: 'fresh') == 'fresh'
+
+
+def test_show_indexes():
+    titles = {'1': '199: a', '2': '199b: b', '3': '200: c', '4': 'speciale', '5': '12: d', '6': 'bonus'}
+    episodes = {}
+    for episode_id, title in titles.items():
+        episode = create_episode_given_title(title)
+        episode.episode_id = episode_id
+        episodes[episode_id] = episode
+
+    show = Show('test_id')
+    show.set_episodes = episodes
+
+    assert show.get_last_episode().episode_id == '3'
+    assert show.get_episode_by_number_and_subletter(199, 'b').episode_id == '2'
+    assert show.get_episode_by_number_and_subletter(199, 'c') is None
+    assert [ep.episode_id for ep in show.get_episodes_by_number(199)] == ['1', '2']
+    assert show.get_episodes_by_number(300) == []
+    assert [ep.episode_id for ep in show.get_not_numbered_episodes()] == ['4', '6']
+    assert show.get_random_episode().episode_id in titles
+
+    # replacing an episode moves it in every index
+    episode = create_episode_given_title('201: e')
+    episode.episode_id = '1'
+    show.set_episodes = {'1': episode}
+    assert show.get_last_episode() is episode
+    assert [ep.episode_id for ep in show.get_episodes_by_number(199)] == ['2']
+    assert show.get_episode_by_number_and_subletter(199, '') is None
+    assert len(show._episode_list) == len(titles)
+
+
+############## Utils ##############
+
+def test_utils_normalize_string():
+    assert Utils.normalize_string("La vita è bella") == "la vita e bella"
+    assert Utils.normalize_string("  Nick   Lorro ") == "nick lorro"
+    assert Utils.normalize_string("Dario Moccia!", True) == "dariomoccia"